@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that extends test_accuracy of classify_countries with a
+sweep mode: it runs a stratified k-fold cross validation of every
+configuration of a grid of classifiers and hyperparameters and prints a
+leaderboard with the mean accuracy, fit time and predict time of each one.
+
+The folds of all the configurations are run by a process pool. The workers
+open the same memory mapped train_X (see feature_store.py), so the training
+matrix is never pickled to them. A compact (or text) train_X of a feature
+configuration is first written once to a temporary float32 matrix, which the
+workers share in the same way.
+
+This program can run indepedently:
+    python accuracy_sweep.py --folds 5 --n-jobs 4
+    python accuracy_sweep.py --classifiers random_forest --grid grid.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.svm import SVC
+import feature_store
+import feature_reduction
+import instrumentation
+
+# classifiers of the sweep
+ESTIMATORS = {'random_forest' : RandomForestClassifier,
+              'extra_trees' : ExtraTreesClassifier,
+              'svc' : SVC}
+
+# hyperparameters of every classifier, every combination is a configuration
+SWEEP_GRID = {'random_forest' : {'n_estimators' : [30, 100],
+                                 'max_features' : ['sqrt', 0.1]},
+              'extra_trees' : {'n_estimators' : [30, 100],
+                               'max_features' : ['sqrt', 0.1]},
+              'svc' : {'C' : [1., 10.], 'gamma' : ['auto']}}
+
+# default number of folds
+FOLDS = 5
+
+# file the leaderboard is saved to
+SWEEP_RESULTS_FILENAME = 'sweep_results.json'
+
+# training data of a worker process, opened once by init_worker
+_X = None
+_y = None
+
+def configurations(grid=SWEEP_GRID, classifiers=None):
+    """
+    Returns the list of (classifier name, hyperparameters) of every
+    combination of the grid.
+
+    Parameters
+    ----------
+    grid : dictionary {classifier name : {parameter : list of values}}.
+
+    classifiers : names of the classifiers to use, None uses all the
+            classifiers of the grid.
+    """
+    result = []
+    for name in sorted(grid):
+        if classifiers is not None and name not in classifiers:
+            continue
+        parameters = sorted(grid[name])
+        for values in itertools.product(*[grid[name][parameter]
+                                          for parameter in parameters]):
+            result.append((name, dict(zip(parameters, values))))
+    return result
+
+def stratified_folds(y, folds=FOLDS, random_state=42):
+    """
+    Returns a list with the test rows of every fold. The rows of every class
+    are shuffled and dealt to the folds in turn, so every fold has about the
+    same share of each class.
+    """
+    random = np.random.RandomState(random_state)
+    fold_of_row = np.empty(len(y), dtype=int)
+    offset = 0
+    for label in np.unique(y):
+        rows = random.permutation(np.flatnonzero(y == label))
+        fold_of_row[rows] = (np.arange(len(rows)) + offset) % folds
+        offset += len(rows)
+    return [np.flatnonzero(fold_of_row == i) for i in range(folds)]
+
+def shared_matrix(name, folder):
+    """
+    Returns the name of a binary matrix with the rows of a matrix that all
+    the workers can memory map. A matrix stored compact or as text (which
+    load_matrix would convert in every worker) is written once to folder as a
+    FEATURES_DTYPE matrix, chunk by chunk.
+    """
+    files = feature_store.matrix_files(name)
+    if len(files) == 1 and files[0].endswith(feature_store.MATRIX_EXTENSION):
+        return name
+    shared_name = os.path.join(folder, os.path.basename(name))
+    writer = None
+    for chunk in feature_store.iter_matrix_chunks(name,
+                                                  feature_reduction.CHUNK_SIZE):
+        if writer is None:
+            writer = feature_store.MatrixWriter(shared_name, chunk.shape[1])
+        writer.append(chunk)
+    if writer is not None:
+        writer.close()
+    return shared_name
+
+def init_worker(X_name, y_name):
+    """
+    Opens the training data in a worker process. The feature matrix is memory
+    mapped, so all the workers share the pages of the same file.
+    """
+    global _X, _y
+    _X = feature_store.load_matrix(X_name)
+    _y = np.asarray(feature_store.load_matrix(y_name))
+
+def run_fold(args):
+    """
+    Trains a configuration on all the folds but one and tests it on that
+    fold. Returns the accuracy, the fit time and the predict time.
+
+    Parameters
+    ----------
+    args : tuple (configuration index, classifier name, hyperparameters,
+            test rows of the fold).
+    """
+    index, name, parameters, test_rows = args
+    train_rows = np.setdiff1d(np.arange(len(_y)), test_rows)
+    clf = ESTIMATORS[name](**parameters)
+
+    start = time.time()
+    clf.fit(_X[train_rows], _y[train_rows])
+    fit_time = time.time() - start
+
+    start = time.time()
+    y_predict = clf.predict(_X[test_rows])
+    predict_time = time.time() - start
+
+    accuracy = np.mean(y_predict == _y[test_rows]) * 100.
+    return index, accuracy, fit_time, predict_time
+
+def sweep(grid=SWEEP_GRID, classifiers=None, folds=FOLDS, n_jobs=1,
+          features=None):
+    """
+    Cross validates every configuration of the grid and returns the
+    leaderboard: a list of results sorted by mean accuracy and fit time.
+
+    Parameters
+    ----------
+    grid : dictionary {classifier name : {parameter : list of values}}.
+
+    classifiers : names of the classifiers to use, None uses all.
+
+    folds : number of folds of the cross validation.
+
+    n_jobs : number of processes. The folds of all the configurations are
+            spread across them.
+
+    features : name of a feature configuration created by feature_reduction.
+            None uses the original matrices.
+    """
+    train_path = feature_reduction.matrices_paths(features)[0]
+    X_name = train_path + 'train_X'
+    y_name = train_path + 'train_y'
+    y = np.asarray(feature_store.load_matrix(y_name))
+
+    sweep_configurations = configurations(grid, classifiers)
+    tasks = [(i, name, parameters, test_rows)
+             for i, (name, parameters) in enumerate(sweep_configurations)
+             for test_rows in stratified_folds(y, folds)]
+
+    with instrumentation.stage('sweep'):
+        if n_jobs > 1:
+            folder = tempfile.mkdtemp()
+            try:
+                pool = multiprocessing.Pool(n_jobs, init_worker,
+                                    (shared_matrix(X_name, folder), y_name))
+                try:
+                    fold_results = pool.map(run_fold, tasks, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                shutil.rmtree(folder)
+        else:
+            init_worker(X_name, y_name)
+            fold_results = [run_fold(task) for task in tasks]
+
+    leaderboard = []
+    for i, (name, parameters) in enumerate(sweep_configurations):
+        results = np.array([result[1:] for result in fold_results
+                            if result[0] == i])
+        leaderboard.append({'classifier' : name, 'parameters' : parameters,
+                            'folds' : folds,
+                            'accuracy' : float(results[:, 0].mean()),
+                            'accuracy_std' : float(results[:, 0].std()),
+                            'fit_s' : float(results[:, 1].mean()),
+                            'predict_s' : float(results[:, 2].mean())})
+    # equal accuracies are ranked by the fit time
+    leaderboard.sort(key=lambda result: (-result['accuracy'],
+                                         result['fit_s']))
+    return leaderboard
+
+def print_leaderboard(leaderboard):
+    print('%-4s %-14s %-36s %14s %9s %11s' % ('rank', 'classifier',
+            'parameters', 'accuracy (%)', 'fit (s)', 'predict (s)'))
+    for rank, result in enumerate(leaderboard):
+        parameters = ', '.join('%s=%s' % (parameter,
+                                          result['parameters'][parameter])
+                               for parameter in sorted(result['parameters']))
+        print('%-4d %-14s %-36s %7.1f +- %4.1f %9.2f %11.3f' % (rank + 1,
+                result['classifier'], parameters, result['accuracy'],
+                result['accuracy_std'], result['fit_s'], result['predict_s']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross validates a grid of '
+                                     'classifiers and hyperparameters.')
+    parser.add_argument('--classifiers', nargs='+',
+                        choices=sorted(ESTIMATORS),
+                        help='classifiers of the sweep (default all)')
+    parser.add_argument('--grid', help='JSON file with the grid '
+                        '{classifier : {parameter : [values]}}')
+    parser.add_argument('--folds', type=int, default=FOLDS)
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='number of processes (0 uses all the cores)')
+    parser.add_argument('--features', help='feature configuration of '
+                        'feature_reduction.py')
+    parser.add_argument('--output', default=SWEEP_RESULTS_FILENAME)
+    args = parser.parse_args()
+
+    grid = SWEEP_GRID
+    if args.grid:
+        with open(args.grid) as grid_file:
+            grid = json.load(grid_file)
+    n_jobs = args.n_jobs
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    leaderboard = sweep(grid, args.classifiers, args.folds, n_jobs,
+                        args.features)
+    print_leaderboard(leaderboard)
+    with open(args.output, 'w') as output_file:
+        json.dump(leaderboard, output_file, indent=2, sort_keys=True)
+    print('Leaderboard written to ' + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -6,50 +6,197 @@ Created on Wed May 18 19:08:46 2016
 
 This is a helper script that contains a function to create a bar chart for an
 input country that shows its matching classification to the tourist themes.
+
+The charts are drawn with the non-interactive Agg backend on one figure
+template per list of themes: only the heights of the bars, their labels and
+the title change from one country to the next, and no figure is left in the
+global state of pyplot. render_charts() can draw the charts of many countries
+in a process pool and skips the countries whose chart is unchanged since the
+last run (see CHARTS_INDEX).
 """
 
+import os
+import json
+import hashlib
+import multiprocessing
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 # folder that the graphs will be saves
 GRAPH_FOLDER = 'countries_graphs/'
 
+# file in GRAPH_FOLDER with the hash of the data of every saved chart
+CHARTS_INDEX = 'charts_index.json'
+
+# changes when the look of the charts changes, so that all are drawn again
+CHART_VERSION = 1
+
+# the width of the bars
+BAR_WIDTH = 0.35
+
+# figure templates of the current process, one for every list of themes
+_renderers = dict()
+
 def autolabel(rects, ax):
     # attach some text labels
+    texts = []
     for rect in rects:
         height = rect.get_height()
-        ax.text(rect.get_x() + rect.get_width()/2., 1.05*height,
-                '%0.2f' % height, ha='center', va='bottom')
+        texts.append(ax.text(rect.get_x() + rect.get_width()/2., 1.05*height,
+                '%0.2f' % height, ha='center', va='bottom'))
+    return texts
+
+class ChartRenderer(object):
+    """
+    A bar chart figure for a list of themes that is drawn once and then
+    updated for every country.
+
+    Parameters
+    ----------
+    labels_list : list of the themes.
+    """
+    def __init__(self, labels_list):
+        N = len(labels_list)
+        ind = np.arange(N) # the x locations for the groups
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.rects = self.ax.bar(ind, np.zeros(N), BAR_WIDTH, color='b')
+
+        # add some text for labels, title and axes ticks
+        self.ax.set_ylabel('Percentage of match')
+        self.title = self.ax.set_title('')
+        self.ax.set_xticks(ind - BAR_WIDTH / 2)
+        self.ax.set_xticklabels(labels_list, rotation=45)
+        self.texts = autolabel(self.rects, self.ax)
 
+    def render(self, country_classification, country, filename):
+        """
+        Draws the chart of a country and saves it to filename.
+        """
+        for rect, text, height in zip(self.rects, self.texts,
+                                      country_classification):
+            rect.set_height(height)
+            text.set_y(1.05 * height)
+            text.set_text('%0.2f' % height)
+        self.title.set_text('Theme match of ' + country.capitalize())
+        self.ax.set_ylim([0, min(1, max(country_classification) + 0.2)])
+        self.figure.savefig(filename, bbox_inches='tight')
+
+    def close(self):
+        self.figure.clear()
+
+def get_renderer(labels_list):
+    """
+    Returns the figure template of a list of themes of the current process.
+    """
+    key = tuple(labels_list)
+    if key not in _renderers:
+        _renderers[key] = ChartRenderer(labels_list)
+    return _renderers[key]
+
+def close_renderers():
+    """
+    Frees the figure templates of the current process.
+    """
+    for renderer in _renderers.values():
+        renderer.close()
+    _renderers.clear()
+
+def chart_filename(country):
+    return GRAPH_FOLDER + 'graph_' + country + '.png'
+
+def chart_hash(country_classification, labels_list, country):
+    """
+    Returns a hash of everything a chart depends on.
+    """
+    description = repr((CHART_VERSION, country, list(labels_list),
+                        np.round(np.asarray(country_classification,
+                                            dtype=float), 6).tolist()))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+def load_charts_index():
+    try:
+        with open(GRAPH_FOLDER + CHARTS_INDEX) as index_file:
+            return json.load(index_file)
+    except (IOError, ValueError):
+        return dict()
+
+def save_charts_index(index):
+    temporary = GRAPH_FOLDER + CHARTS_INDEX + '.tmp'
+    with open(temporary, 'w') as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
+    os.rename(temporary, GRAPH_FOLDER + CHARTS_INDEX)
+
+def render_chart(args):
+    """
+    Draws and saves the chart of a country with the figure template of the
+    current process.
+
+    Parameters
+    ----------
+    args : tuple (country classification, list of themes, country name).
+    """
+    country_classification, labels_list, country = args
+    get_renderer(labels_list).render(country_classification, country,
+                                     chart_filename(country))
 
 def show_country_bar_chart(country_classification, labels_list, country):
     """
     Creates a bar chart of a country matching of the tourist themes.
-    
+
     Parameters
     ----------
-    country_classification : Location of file to load.
-    
-    labels_list : numpy array of the sum of images classified in each theme.
-    
+    country_classification : numpy array of the sum of images classified in
+            each theme.
+
+    labels_list : list of the themes.
+
     country : name of the country.
     """
-    N = len(country_classification)
-    ind = np.arange(N) # the x locations for the groups
-    width = 0.35       # the width of the bars
-    fig, ax = plt.subplots()
-    rects = ax.bar(ind, country_classification, width, color='b')
-    
-    # add some text for labels, title and axes ticks
-    ax.set_ylabel('Percentage of match')
-    ax.set_title('Theme match of ' + country.capitalize())
-    ax.set_xticks(ind - width / 2)
-    ax.set_xticklabels(labels_list, rotation=45)
-    
-    axes = plt.gca()
-    axes.set_ylim([0, min(1, max(country_classification) + 0.2)])
-    
-    autolabel(rects, ax)
-#    plt.show()
-    plt.savefig(GRAPH_FOLDER + 'graph_' + country + '.png', 
-                                                        bbox_inches='tight')
\ No newline at end of file
+    render_chart((country_classification, labels_list, country))
+
+def render_charts(charts, workers=1, force=False):
+    """
+    Creates the bar charts of many countries and returns the number of charts
+    that were drawn.
+
+    Parameters
+    ----------
+    charts : list of tuples (country classification, list of themes, country
+            name).
+
+    workers : number of processes drawing the charts.
+
+    force : if False the charts whose data did not change since the last run
+            are not drawn again.
+    """
+    if not os.path.isdir(GRAPH_FOLDER):
+        os.makedirs(GRAPH_FOLDER)
+    index = load_charts_index()
+
+    # keep only the charts that are new or changed
+    hashes = [chart_hash(*chart) for chart in charts]
+    changed = [i for i in range(len(charts)) if force or
+               index.get(charts[i][2]) != hashes[i] or
+               not os.path.exists(chart_filename(charts[i][2]))]
+    tasks = [(np.asarray(charts[i][0], dtype=float), list(charts[i][1]),
+              charts[i][2]) for i in changed]
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            pool.map(render_chart, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            render_chart(task)
+        close_renderers()
+
+    for i in changed:
+        index[charts[i][2]] = hashes[i]
+    save_charts_index(index)
+    return len(tasks)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper program that computes the RGB and HOG features of a batch of
+images at once. Every image is decoded and resized once, the batch is stored
+in one (N, IMAGE_SIZE, IMAGE_SIZE, 3) uint8 array and the grayscale
+conversion, the gradients and the HOG cell and block histograms are computed
+with NumPy operations over the whole batch.
+
+The features are the same (up to floating point rounding) as the features of
+create_images_feature_matrices.image_features, which calls skimage's hog once
+per image.
+
+This program can run indepedently to benchmark the two extractors:
+    python batch_features.py --images 'train_data/*/*' --limit 500
+"""
+
+import glob
+import time
+import argparse
+import numpy as np
+from PIL import Image
+import instrumentation
+
+# default parameters of skimage.feature.hog
+HOG_PIXELS_PER_CELL = 8
+HOG_CELLS_PER_BLOCK = 3
+
+# number of images decoded and processed together
+BATCH_SIZE = 64
+
+def decode_images(files, image_size):
+    """
+    Decodes and resizes a list of images (file names or file objects) into one
+    (N, image_size, image_size, 3) uint8 array.
+    """
+    images = np.empty([len(files), image_size, image_size, 3], dtype=np.uint8)
+    for i in range(len(files)):
+        image = Image.open(files[i])
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        images[i] = np.asarray(image.resize([image_size, image_size]))
+    return images
+
+def rgb_to_gray(images):
+    """
+    Converts a batch of RGB images to grayscale with the same integer formula
+    as PIL's convert('L') (ITU-R 601-2 luma).
+    """
+    images = images.astype(np.uint32)
+    gray = (images[..., 0] * 19595 + images[..., 1] * 38470 +
+            images[..., 2] * 7471 + 0x8000) >> 16
+    return gray.astype(np.uint8)
+
+def batch_hog(gray, orientations, pixels_per_cell=HOG_PIXELS_PER_CELL,
+              cells_per_block=HOG_CELLS_PER_BLOCK):
+    """
+    Computes the HOG features of a batch of grayscale images, like skimage's
+    hog(image, orientations) with 'L2-Hys' block normalization does for a
+    single image.
+
+    Parameters
+    ----------
+    gray : (N, rows, columns) array of grayscale images.
+
+    orientations : number of orientation bins.
+
+    pixels_per_cell : size (in pixels) of a square cell.
+
+    cells_per_block : size (in cells) of a square block.
+    """
+    images = gray.astype(np.float64)
+    number, rows, columns = images.shape
+
+    # first order gradients (zero at the borders)
+    g_row = np.zeros_like(images)
+    g_row[:, 1:-1, :] = images[:, 2:, :] - images[:, :-2, :]
+    g_col = np.zeros_like(images)
+    g_col[:, :, 1:-1] = images[:, :, 2:] - images[:, :, :-2]
+
+    # keep only the pixels of complete cells
+    cells_rows = rows // pixels_per_cell
+    cells_columns = columns // pixels_per_cell
+    g_row = g_row[:, :cells_rows * pixels_per_cell,
+                  :cells_columns * pixels_per_cell]
+    g_col = g_col[:, :cells_rows * pixels_per_cell,
+                  :cells_columns * pixels_per_cell]
+
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+    bins = np.minimum((orientation / (180. / orientations)).astype(np.intp),
+                      orientations - 1)
+
+    # index of the (image, cell row, cell column, bin) every pixel votes for
+    pixel_rows = np.arange(cells_rows * pixels_per_cell) // pixels_per_cell
+    pixel_columns = (np.arange(cells_columns * pixels_per_cell) //
+                     pixels_per_cell)
+    cells = (pixel_rows[:, np.newaxis] * cells_columns +
+             pixel_columns[np.newaxis, :])
+    index = ((np.arange(number)[:, np.newaxis, np.newaxis] * cells_rows *
+              cells_columns + cells[np.newaxis]) * orientations + bins)
+    histogram = np.bincount(index.ravel(), weights=magnitude.ravel(),
+                            minlength=number * cells_rows * cells_columns *
+                            orientations)
+    histogram = histogram.reshape([number, cells_rows, cells_columns,
+                                   orientations])
+    histogram /= pixels_per_cell * pixels_per_cell
+
+    # overlapping blocks of cells_per_block x cells_per_block cells
+    blocks_rows = cells_rows - cells_per_block + 1
+    blocks_columns = cells_columns - cells_per_block + 1
+    blocks = np.empty([number, blocks_rows, blocks_columns, cells_per_block,
+                       cells_per_block, orientations])
+    for r in range(cells_per_block):
+        for c in range(cells_per_block):
+            blocks[:, :, :, r, c, :] = histogram[:, r:r + blocks_rows,
+                                                 c:c + blocks_columns, :]
+
+    # L2-Hys normalization of every block
+    eps = 1e-5
+    axes = (3, 4, 5)
+    blocks /= np.sqrt(np.sum(blocks ** 2, axis=axes, keepdims=True) + eps ** 2)
+    np.minimum(blocks, 0.2, out=blocks)
+    blocks /= np.sqrt(np.sum(blocks ** 2, axis=axes, keepdims=True) + eps ** 2)
+    return blocks.reshape([number, -1])
+
+def batch_image_features(files, image_size, orientations):
+    """
+    Returns the features (flattened RGB values followed by the HOG features)
+    of a batch of images as an (N, features) array.
+
+    Parameters
+    ----------
+    files : list of image files (file names or file objects).
+
+    image_size : size to resize the images to.
+
+    orientations : number of orientation bins of the HOG features.
+    """
+    with instrumentation.stage('decode'):
+        images = decode_images(files, image_size)
+    instrumentation.count('images_decoded', len(files))
+    with instrumentation.stage('hog'):
+        hog_features = batch_hog(rgb_to_gray(images), orientations)
+    return np.hstack([images.reshape([len(files), -1]), hog_features])
+
+def iter_batch_features(files, image_size, orientations,
+                        batch_size=BATCH_SIZE):
+    """
+    Yields the features of a list of images batch by batch.
+    """
+    for start in range(0, len(files), batch_size):
+        yield batch_image_features(files[start:start + batch_size],
+                                   image_size, orientations)
+
+def benchmark(files, batch_size=BATCH_SIZE):
+    """
+    Compares the per image extractor of create_images_feature_matrices with the
+    batch extractor of this module. Prints the images per second of both and
+    the largest difference between their features.
+    """
+    # imported here because create_images_feature_matrices uses this module
+    import create_images_feature_matrices as create_matrices
+
+    start = time.time()
+    single = np.array([create_matrices.image_features(file_)
+                       for file_ in files])
+    single_time = time.time() - start
+
+    start = time.time()
+    batch = np.vstack(list(iter_batch_features(files,
+                create_matrices.IMAGE_SIZE, create_matrices.HOG_ORIENTATIONS,
+                batch_size)))
+    batch_time = time.time() - start
+
+    difference = np.abs(single - batch).max()
+    print('%d images, batches of %d' % (len(files), batch_size))
+    print('per image : %8.1f images/s' % (len(files) / single_time))
+    print('batch     : %8.1f images/s' % (len(files) / batch_time))
+    print('max feature difference: %g' % difference)
+    return {'images' : len(files),
+            'single_images_per_second' : len(files) / single_time,
+            'batch_images_per_second' : len(files) / batch_time,
+            'max_difference' : float(difference)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the batch '
+                                     'feature extractor.')
+    parser.add_argument('--images', default='train_data/*/*',
+                        help='glob pattern of the images')
+    parser.add_argument('--limit', type=int, default=500,
+                        help='maximum number of images')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(args.images))[:args.limit]
+    if not files:
+        print('No images found in ' + args.images)
+        return
+    benchmark(files, args.batch_size)
+
+if __name__ == '__main__':
+    main()
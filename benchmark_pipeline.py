@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that benchmarks every stage of the pipeline on synthetic
+data of configurable size (themes x images, countries x images):
+
+    extract     : create_images_feature_matrices.create_data
+    load_text   : np.loadtxt of the training matrix
+    load_binary : feature_store.load_matrix of the training matrix
+    train       : fit of the classifier
+    predict     : classify_countries.score_countries of all countries
+    bar_charts  : bar_chart_graph.render_charts for every country
+    world_map   : create_world_map_graph.create_world_map
+
+Every stage runs in its own process, so the peak resident memory (RSS) of a
+stage is not hidden by the stages before it. The results are written to a JSON
+file and can be compared with the results of an earlier run.
+
+This program can run indepedently:
+    python benchmark_pipeline.py --themes 6 --images 200 --countries 10
+    python benchmark_pipeline.py --compare old_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import resource
+import multiprocessing
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from PIL import Image
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+import create_images_feature_matrices as create_matrices
+import bar_chart_graph as show_bar
+import classify_countries
+import feature_store
+import model_registry
+
+# names of the synthetic countries (real names, so the world map can color
+# them)
+COUNTRY_NAMES = ['austria', 'brazil', 'canada', 'egypt', 'finland', 'france',
+                 'greece', 'iceland', 'india', 'italy', 'morocco', 'nepal',
+                 'norway', 'chile', 'croatia', 'denmark']
+
+# order of the stages
+STAGES = ['extract', 'load_text', 'load_binary', 'train', 'predict',
+          'bar_charts', 'world_map']
+
+# file of the trained model passed from the train to the predict stage
+MODEL_FILENAME = 'benchmark_model.pkl'
+
+def country_names(countries):
+    names = COUNTRY_NAMES[:countries]
+    for i in range(len(names), countries):
+        names.append('country%d' % i)
+    return names
+
+def create_image_tree(themes, images, countries, country_images, image_size,
+                      seed=0):
+    """
+    Creates train_data/<theme>/ and test_data/visit_<country>/ folders with
+    synthetic JPEG images in the current folder.
+    """
+    random = np.random.RandomState(seed)
+    rows, columns = np.mgrid[0:image_size, 0:image_size]
+
+    def save_image(path):
+        # smooth gradients plus noise, so that HOG has some structure
+        image = np.dstack([(columns * random.rand() + rows * random.rand()),
+                           128 + 127 * np.sin(columns / (5. + 30 *
+                                                         random.rand())),
+                           random.rand(image_size, image_size) * 255])
+        Image.fromarray((image % 256).astype(np.uint8)).save(path)
+
+    for theme in range(themes):
+        folder = os.path.join('train_data', 'theme%d' % theme)
+        os.makedirs(folder)
+        for i in range(images):
+            save_image(os.path.join(folder, 'image%d.jpg' % i))
+    for country in country_names(countries):
+        folder = os.path.join('test_data', 'visit_' + country)
+        os.makedirs(folder)
+        for i in range(country_images):
+            save_image(os.path.join(folder, 'image%d.jpg' % i))
+
+def create_synthetic_matrices(themes, images, countries, country_images,
+                              seed=0):
+    """
+    Creates random train and test feature matrices (and class_themes.txt)
+    without any images, to benchmark the stages after the extraction.
+    """
+    random = np.random.RandomState(seed)
+    rgb_size = create_matrices.IMAGE_SIZE * create_matrices.IMAGE_SIZE * 3
+    columns = create_matrices.features_size()
+
+    def random_matrix(rows):
+        matrix = np.empty([rows, columns], dtype=feature_store.FEATURES_DTYPE)
+        matrix[:, :rgb_size] = random.randint(256, size=[rows, rgb_size])
+        matrix[:, rgb_size:] = random.rand(rows, columns - rgb_size)
+        return matrix
+
+    feature_store.save_matrix(create_matrices.TRAIN_MATRICES_EXPORT_PATH +
+                              'train_X', random_matrix(themes * images))
+    feature_store.save_matrix(create_matrices.TRAIN_MATRICES_EXPORT_PATH +
+                              'train_y', np.repeat(np.arange(themes), images),
+                              feature_store.LABELS_DTYPE)
+    with open(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt',
+              'w') as class_file:
+        for theme in range(themes):
+            class_file.write('theme%d\n' % theme)
+    for country in country_names(countries):
+        feature_store.save_matrix(create_matrices.TEST_MATRICES_EXPORT_PATH +
+                                  'test_X_' + country,
+                                  random_matrix(country_images))
+
+def peak_rss():
+    """
+    Returns the peak resident memory (in megabytes) of this process and of its
+    finished child processes.
+    """
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / (1024. * 1024.)
+    return peak / 1024.
+
+def train_matrices():
+    return (create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X',
+            create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y')
+
+def test_matrices():
+    return feature_store.list_matrices(
+                        create_matrices.TEST_MATRICES_EXPORT_PATH + 'test_X_*')
+
+def stage_extract(config):
+    decoded = create_matrices.create_data(config['workers'], use_cache=False,
+                                          dedup=False)[0]
+    return {'images' : decoded}
+
+def stage_load_text(config):
+    X = np.loadtxt(train_matrices()[0] + feature_store.TEXT_EXTENSION)
+    return {'rows' : X.shape[0]}
+
+def stage_load_binary(config):
+    X = feature_store.load_matrix(train_matrices()[0])
+    # touch every value so that the lazy loading is also measured
+    X.sum()
+    return {'rows' : X.shape[0]}
+
+def stage_train(config):
+    X_name, y_name = train_matrices()
+    X = feature_store.load_matrix(X_name)
+    y = feature_store.load_matrix(y_name)
+    clf = model_registry.create_classifier(config['classifier'])
+    start = time.time()
+    clf.fit(X, y)
+    fit_time = time.time() - start
+    joblib.dump(clf, MODEL_FILENAME)
+    return {'fit_s' : fit_time}
+
+def stage_predict(config):
+    clf = joblib.load(MODEL_FILENAME)
+    labels_number = len(classify_countries.load_labels())
+    aggregator = classify_countries.score_countries(clf, test_matrices(),
+                                                    labels_number)
+    return {'rows' : int(aggregator.rows.sum())}
+
+def stage_bar_charts(config):
+    labels_list = classify_countries.load_labels()
+    random = np.random.RandomState(0)
+    countries = test_matrices()
+    charts = [(random.rand(len(labels_list)), labels_list,
+               os.path.basename(country_filename).split('_')[2])
+              for country_filename in countries]
+    rendered = show_bar.render_charts(charts, config['workers'], force=True)
+    return {'charts' : rendered}
+
+def stage_world_map(config):
+    # optional dependencies, the stage is skipped without them
+    import create_world_map_graph
+    labels_list = classify_countries.load_labels()
+    with open('country_main_themes.txt', 'w') as main_themes_file:
+        for i, country_filename in enumerate(test_matrices()):
+            country = os.path.basename(country_filename).split('_')[2]
+            main_themes_file.write(country.capitalize() + ':' +
+                                   labels_list[i % len(labels_list)] + '\n')
+    create_world_map_graph.create_world_map()
+    return {}
+
+def stage_worker(stage, config, results):
+    """
+    Runs a stage in a child process and puts its time, peak memory and extra
+    measurements to the results queue.
+    """
+    try:
+        start = time.time()
+        extra = globals()['stage_' + stage](config)
+        result = {'time_s' : time.time() - start}
+        result.update(extra)
+    except ImportError as error:
+        result = {'skipped' : str(error)}
+    except Exception as error:
+        result = {'error' : '%s: %s' % (type(error).__name__, error)}
+    result['peak_rss_mb'] = peak_rss()
+    results.put(result)
+
+def run_stage(stage, config):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=stage_worker,
+                                      args=(stage, config, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run_benchmark(config, stages=STAGES):
+    """
+    Creates the synthetic data in a temporary folder, runs every stage and
+    returns the results.
+
+    Parameters
+    ----------
+    config : dictionary with the size of the data ('themes', 'images',
+            'countries', 'country_images', 'image_size'), the number of
+            'workers' of the extraction and the charts, the 'classifier' id and 'skip_images'
+            (use random matrices instead of images, the extract stage is then
+            skipped).
+
+    stages : stages to run.
+    """
+    folder = tempfile.mkdtemp()
+    current_folder = os.getcwd()
+    results = {'config' : config, 'stages' : dict(),
+               'python' : platform.python_version(),
+               'machine' : platform.machine(),
+               'cpus' : multiprocessing.cpu_count(),
+               'date' : time.ctime()}
+    try:
+        # all the paths of the pipeline are relative to the current folder
+        os.chdir(folder)
+        for path in [create_matrices.TRAIN_MATRICES_EXPORT_PATH,
+                     create_matrices.TEST_MATRICES_EXPORT_PATH,
+                     show_bar.GRAPH_FOLDER]:
+            os.makedirs(path)
+
+        if config['skip_images']:
+            create_synthetic_matrices(config['themes'], config['images'],
+                        config['countries'], config['country_images'])
+            stages = [stage for stage in stages if stage != 'extract']
+        else:
+            create_image_tree(config['themes'], config['images'],
+                    config['countries'], config['country_images'],
+                    config['image_size'])
+            if 'extract' in stages:
+                results['stages']['extract'] = run_stage('extract', config)
+                stages = [stage for stage in stages if stage != 'extract']
+            else:
+                create_matrices.create_data(config['workers'], False, False)
+
+        # text copy of the training matrix for the load_text stage
+        np.savetxt(train_matrices()[0] + feature_store.TEXT_EXTENSION,
+                   feature_store.load_matrix(train_matrices()[0]))
+
+        for stage in stages:
+            results['stages'][stage] = run_stage(stage, config)
+    finally:
+        os.chdir(current_folder)
+        shutil.rmtree(folder)
+    return results
+
+def print_results(results, baseline=None):
+    """
+    Prints the results of a run. If the results of an earlier run are given,
+    the ratio of the times (current / earlier) is printed too.
+    """
+    print('%-12s %10s %14s %8s' % ('stage', 'time (s)', 'peak RSS (MB)',
+                                   'ratio' if baseline else ''))
+    for stage in STAGES:
+        if stage not in results['stages']:
+            continue
+        result = results['stages'][stage]
+        if 'time_s' not in result:
+            print('%-12s %s' % (stage, result.get('skipped') or
+                                result.get('error')))
+            continue
+        ratio = ''
+        if baseline and 'time_s' in baseline['stages'].get(stage, {}):
+            ratio = '%8.2f' % (result['time_s'] /
+                               max(baseline['stages'][stage]['time_s'], 1e-9))
+        print('%-12s %10.3f %14.1f %s' % (stage, result['time_s'],
+                                          result['peak_rss_mb'], ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of '
+                                     'the pipeline on synthetic data.')
+    parser.add_argument('--themes', type=int, default=6)
+    parser.add_argument('--images', type=int, default=100,
+                        help='training images per theme')
+    parser.add_argument('--countries', type=int, default=5)
+    parser.add_argument('--country-images', type=int, default=100,
+                        help='images per country')
+    parser.add_argument('--image-size', type=int, default=320,
+                        help='width and height of the synthetic images')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes of the extract stage')
+    parser.add_argument('--classifier', type=int, default=0)
+    parser.add_argument('--skip-images', action='store_true',
+                        help='use random feature matrices instead of images')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=STAGES)
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    config = {'themes' : args.themes, 'images' : args.images,
+              'countries' : args.countries,
+              'country_images' : args.country_images,
+              'image_size' : args.image_size, 'workers' : args.workers,
+              'classifier' : args.classifier,
+              'skip_images' : args.skip_images}
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run_benchmark(config, args.stages)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print_results(results, baseline)
+    print('Results written to ' + output)
+
+if __name__ == '__main__':
+    main()
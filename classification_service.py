@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that runs a local HTTP service which classifies new photo
+sets on demand. The trained classifier (see model_registry.py) and the class
+labels are loaded once when the service starts.
+
+Requests that arrive at the same time are grouped in micro-batches, so a
+single predict_proba call classifies the images of several requests.
+
+Endpoints:
+    POST /classify : classifies a set of images. The body is either
+        - an image file (Content-Type: image/...), or
+        - JSON {"features": [[...], ...]} with one feature row per image, or
+        - JSON {"images": ["<base64 image>", ...]}.
+        The response contains the mean score of every theme, the main theme
+        and latency metrics.
+    GET /metrics : statistics of the served requests.
+    GET /health : returns "ok" when the service is ready.
+
+This program can run indepedently:
+    python classification_service.py --port 8080
+    python classification_service.py --socket /tmp/themes.sock
+"""
+
+import io
+import os
+import json
+import time
+import base64
+import argparse
+import threading
+import collections
+import numpy as np
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    import queue
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    import Queue as queue
+import create_images_feature_matrices as create_matrices
+import classify_countries
+import feature_store
+import model_registry
+
+# maximum number of images classified by one predict_proba call
+MAX_BATCH_ROWS = 512
+
+# maximum time (in seconds) a request waits for other requests to join its
+# batch
+MAX_BATCH_WAIT = 0.01
+
+# maximum time (in seconds) a request waits for its result
+REQUEST_TIMEOUT = 60.
+
+# number of latencies kept for the metrics
+LATENCY_HISTORY = 1000
+
+class ClassificationRequest(object):
+    """
+    A set of feature rows waiting to be classified.
+    """
+    def __init__(self, features):
+        self.features = features
+        self.created = time.time()
+        self.done = threading.Event()
+        self.probabilities = None
+        self.error = None
+        self.latency = dict()
+
+class MicroBatcher(object):
+    """
+    Classifies requests in a background thread. Every request waiting in the
+    queue is added to the current batch until the batch has max_batch_rows
+    rows or max_wait seconds have passed since its first request arrived. The
+    rows of the whole batch are classified with a single predict_proba call.
+
+    Parameters
+    ----------
+    clf : trained classifier.
+
+    max_batch_rows : maximum number of rows of a batch.
+
+    max_wait : maximum waiting time (in seconds) for a batch to fill.
+    """
+    def __init__(self, clf, max_batch_rows=MAX_BATCH_ROWS,
+                 max_wait=MAX_BATCH_WAIT):
+        self.clf = clf
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def classify(self, features):
+        """
+        Queues the feature rows of a request and waits for their class
+        probabilities.
+        """
+        request = ClassificationRequest(features)
+        self.requests.put(request)
+        if not request.done.wait(REQUEST_TIMEOUT):
+            raise RuntimeError('Classification timed out')
+        if request.error is not None:
+            raise request.error
+        request.latency['total_ms'] = (time.time() - request.created) * 1000
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['rows'] += len(features)
+            self.latencies.append(request.latency['total_ms'])
+        return request.probabilities, request.latency
+
+    def next_batch(self):
+        # block until the first request of the batch arrives
+        batch = [self.requests.get()]
+        rows = len(batch[0].features)
+        deadline = time.time() + self.max_wait
+        while rows < self.max_batch_rows:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request.features)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start = time.time()
+            offsets = np.cumsum([0] + [len(request.features)
+                                       for request in batch])
+            try:
+                probabilities = self.clf.predict_proba(
+                    np.concatenate([request.features for request in batch]))
+            except Exception as error:
+                for request in batch:
+                    request.error = error
+                    request.done.set()
+                continue
+            predict_ms = (time.time() - start) * 1000
+
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['batch_rows'] += int(offsets[-1])
+            for i in range(len(batch)):
+                request = batch[i]
+                request.probabilities = probabilities[offsets[i]:
+                                                      offsets[i + 1]]
+                request.latency = {
+                    'queue_ms' : (start - request.created) * 1000,
+                    'predict_ms' : predict_ms,
+                    'batch_requests' : len(batch),
+                    'batch_rows' : int(offsets[-1])}
+                request.done.set()
+
+    def metrics(self):
+        """
+        Returns statistics of the served requests.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            latencies = np.array(self.latencies)
+        if stats.get('batches'):
+            stats['mean_batch_rows'] = (stats['batch_rows'] /
+                                        float(stats['batches']))
+        if len(latencies):
+            stats['latency_ms'] = {
+                'p50' : float(np.percentile(latencies, 50)),
+                'p95' : float(np.percentile(latencies, 95)),
+                'max' : float(latencies.max())}
+        return stats
+
+class ClassificationService(object):
+    """
+    Holds the trained classifier, the class labels and the micro-batcher.
+
+    Parameters
+    ----------
+    classifier : classifier id (see model_registry.create_classifier).
+    """
+    def __init__(self, classifier=0, max_batch_rows=MAX_BATCH_ROWS,
+                 max_wait=MAX_BATCH_WAIT):
+        start = time.time()
+        self.labels_list = classify_countries.load_labels()
+        self.features_number = feature_store.load_matrix(
+            create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X').shape[1]
+        # uploaded images are extracted like the training images
+        self.feature_set = create_matrices.load_feature_set()
+        self.clf = model_registry.warm_model(classifier)
+        # columns of predict_proba in the order of the labels list
+        self.themes = [self.labels_list[int(label)]
+                       for label in self.clf.classes_]
+        self.batcher = MicroBatcher(self.clf, max_batch_rows, max_wait)
+        self.load_time = time.time() - start
+
+    def image_rows(self, images):
+        """
+        Returns the feature rows of a list of encoded images.
+        """
+        start = time.time()
+        rows = self.feature_set.extract([io.BytesIO(image) 
+                                         for image in images])
+        return rows, (time.time() - start) * 1000
+
+    def classify(self, features, extract_ms=0.):
+        """
+        Classifies the feature rows of a photo set and returns the mean score
+        of every theme, the main theme and latency metrics.
+        """
+        features = np.asarray(features, dtype=feature_store.FEATURES_DTYPE)
+        if features.ndim != 2 or features.shape[1] != self.features_number:
+            raise ValueError('Expected rows of %d features' %
+                             self.features_number)
+        probabilities, latency = self.batcher.classify(features)
+        latency['extract_ms'] = extract_ms
+
+        scores = probabilities.mean(axis=0)
+        return {'images' : len(features),
+                'scores' : dict(zip(self.themes, scores.tolist())),
+                'main_theme' : self.themes[int(np.argmax(scores))],
+                'latency' : latency}
+
+    def metrics(self):
+        metrics = self.batcher.metrics()
+        metrics['load_time_s'] = self.load_time
+        return metrics
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the service. The service is attached to the server.
+    """
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status' : 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics())
+        else:
+            self.send_json(404, {'error' : 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error' : 'Unknown path ' + self.path})
+            return
+        service = self.server.service
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        try:
+            extract_ms = 0.
+            if content_type.startswith('image/'):
+                features, extract_ms = service.image_rows([body])
+            else:
+                content = json.loads(body.decode('utf-8'))
+                if 'features' in content:
+                    features = content['features']
+                else:
+                    features, extract_ms = service.image_rows(
+                        [base64.b64decode(image)
+                         for image in content['images']])
+            self.send_json(200, service.classify(features, extract_ms))
+        except (ValueError, KeyError, TypeError, IOError) as error:
+            self.send_json(400, {'error' : str(error)})
+        except RuntimeError as error:
+            self.send_json(503, {'error' : str(error)})
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadedUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def create_server(service, host='127.0.0.1', port=8080, socket_path=None):
+    """
+    Creates the server of the service, listening on a TCP port or, if
+    socket_path is given, on a Unix socket.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadedUnixServer(socket_path, ClassificationHandler)
+    else:
+        server = ThreadedHTTPServer((host, port), ClassificationHandler)
+    server.service = service
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Local service that '
+                                     'classifies photo sets to themes.')
+    parser.add_argument('--classifier', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', help='listen on a Unix socket instead '
+                        'of a TCP port')
+    parser.add_argument('--max-batch-rows', type=int, default=MAX_BATCH_ROWS)
+    parser.add_argument('--max-wait-ms', type=float,
+                        default=MAX_BATCH_WAIT * 1000)
+    args = parser.parse_args()
+
+    service = ClassificationService(args.classifier, args.max_batch_rows,
+                                    args.max_wait_ms / 1000.)
+    server = create_server(service, args.host, args.port, args.socket)
+    print('Model loaded in %.2f s, listening on %s' % (service.load_time,
+                    args.socket or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
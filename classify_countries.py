@@ -10,24 +10,41 @@ test data. It tests the accuracy of the classifier. Then it classifies the
 countries based on their feature matrices, creates a bar chart for each
 country matching and finally it outputs a world map depicted all the tested 
 countries colored in the matching tourist theme.
+
+With --profile the stages of the run are timed (see instrumentation.py) and a
+run report is written to run_report.json.
+
+The modules that load scikit-learn, matplotlib or cartopy are imported by the
+functions that use them, so importing this module is fast. See tourist.py for
+a command line with subcommands for every step.
 """
 
 import create_images_feature_matrices as create_matrices
-import bar_chart_graph as show_bar
-import create_world_map_graph
+import feature_store
+import instrumentation
+import theme_aggregation
 import numpy as np
-import glob
-from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
-from sklearn import cross_validation
-from sklearn.svm import SVC
-from sklearn.ensemble import VotingClassifier
+import os
+import argparse
+
+# number of feature rows (images) of a country that are predicted at once
+PREDICT_CHUNK_SIZE = 1000
+
+# how the class probabilities of the images of a country are aggregated (see
+# theme_aggregation.py), the default is the hard vote of the images
+AGGREGATION_MODE = 'vote'
+
+# file with the main theme of every country and its confidence
+CONFIDENCE_FILENAME = 'country_theme_confidence.txt'
 
 def create_data():
     """
     This function calls the program 'create_images_feature_matrices' to create 
-    the train and test data if they have not yet been generated.
+    the train and test data. Only new or changed images are decoded, the 
+    features of the rest are read from the feature cache. The matrices keep 
+    the feature set they were created with.
     """
-    create_matrices.main()
+    create_matrices.create_data()
 
 def plot_world_map():
     """
@@ -35,13 +52,116 @@ def plot_world_map():
     world map of all tested countries coloured in their corresponding main 
     tourism theme.
     """
+    with instrumentation.imports():
+        import create_world_map_graph
     create_world_map_graph.create_world_map()
     
-def classify_countries(classifier=0):
+def load_labels():
+    """
+    This function loads the class labels (themes). Classification equal to 0
+    corresponds to the first label and so on.
+    """
+    labels_list = []
+    with open(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt') as class_labels:
+        for label in class_labels:
+            labels_list.append(label.replace('\n',''))
+    return labels_list
+    
+def iter_country_batches(country_filenames, batch_size=PREDICT_CHUNK_SIZE):
+    """
+    Reads the feature matrices of many countries one after the other and 
+    yields batches of rows that mix countries. Every batch is a tuple 
+    (features, offsets, countries): the rows of countries[i] are 
+    features[offsets[i]:offsets[i + 1]].
+    
+    Parameters
+    ----------
+    country_filenames : names of the feature matrices of the countries.
+    
+    batch_size : number of rows of a batch (the last one may be smaller). If
+            None all the rows of all the countries are one batch.
+    """
+    pieces = []
+    countries = []
+    rows = 0
+    for i in range(len(country_filenames)):
+        if batch_size is None:
+            chunks = [feature_store.load_matrix(country_filenames[i])]
+        else:
+            chunks = feature_store.iter_matrix_chunks(country_filenames[i], 
+                                                      batch_size)
+        for chunk in chunks:
+            start = 0
+            while start < len(chunk):
+                take = len(chunk) - start
+                if batch_size is not None:
+                    take = min(take, batch_size - rows)
+                pieces.append(chunk[start:start + take])
+                countries.append(i)
+                rows += take
+                start += take
+                if rows == batch_size:
+                    yield (np.concatenate(pieces), np.cumsum([0] + 
+                           [len(piece) for piece in pieces]), countries)
+                    pieces = []
+                    countries = []
+                    rows = 0
+    if rows:
+        yield (np.concatenate(pieces), np.cumsum([0] + 
+               [len(piece) for piece in pieces]), countries)
+    
+def score_countries(clf, country_filenames, labels_number, 
+                    mode=AGGREGATION_MODE, top_k=2, 
+                    batch_size=PREDICT_CHUNK_SIZE, batched=True):
+    """
+    This function computes the class probabilities of the images of many
+    countries batch by batch and aggregates them to a score of every theme. 
+    It returns a theme_aggregation.ThemeAggregator.
+    
+    Parameters
+    ----------
+    clf : trained classifier.
+    
+    country_filenames : names of the feature matrices of the countries.
+    
+    labels_number : number of themes.
+    
+    mode : aggregation mode ('vote', 'mean', 'log' or 'topk').
+    
+    top_k : number of themes every image votes for in topk mode.
+    
+    batch_size : number of rows predicted at once. If None all the rows are
+            predicted at once.
+            
+    batched : if True the images of all the countries are predicted together,
+            otherwise every country is predicted on its own.
+    """
+    aggregator = theme_aggregation.ThemeAggregator(labels_number, 
+                                        len(country_filenames), mode, top_k)
+    if batched:
+        groups = [(0, country_filenames)]
+    else:
+        groups = [(i, [country_filenames[i]]) 
+                                        for i in range(len(country_filenames))]
+    for first, filenames in groups:
+        for X_test, offsets, countries in iter_country_batches(filenames, 
+                                                               batch_size):
+            with instrumentation.stage('predict'):
+                probabilities = clf.predict_proba(X_test)
+            instrumentation.count('rows_predicted', len(X_test))
+            aggregator.update(probabilities, offsets, 
+                              np.add(countries, first), clf.classes_)
+    return aggregator
+    
+def classify_countries(classifier=0, chunk_size=PREDICT_CHUNK_SIZE, 
+                       features=None, chart_workers=1, batched=True,
+                       mode=AGGREGATION_MODE, top_k=2):
     """
     This function loads the training data and trains a machine learning 
     classifier. It then loads the test data for each country and classifies it. 
     Finally, it saves a bar chart of this classification.
+    The main theme of every country is saved in country_main_themes.txt and 
+    with its confidence in CONFIDENCE_FILENAME.
     
     Parameters
     ----------
@@ -55,80 +175,102 @@ def classify_countries(classifier=0):
                                 2) Etremely Randomized Trees Classifier with
                                     weight=1.
                                 3) Support Vector Machine with weight=2.
+                                
+    chunk_size : number of images that are predicted at once. If None all the
+            images (of a country, or of all the countries if batched) are 
+            predicted at once.
+            
+    features : name of a feature configuration created by feature_reduction
+            (compact or reduced matrices). None uses the original matrices.
+            
+    chart_workers : number of processes drawing the bar charts. Charts of 
+            countries whose classification did not change are not drawn again.
+            
+    batched : if True the images of all the countries are predicted together 
+            in batches of chunk_size rows, otherwise every country is 
+            predicted on its own.
+            
+    mode : how the class probabilities of the images of a country are 
+            aggregated to the scores of the themes ('vote', 'mean', 'log' or 
+            'topk', see theme_aggregation.py).
+            
+    top_k : number of themes every image votes for in topk mode.
     """
-    # load the training data
-    train_X = np.loadtxt(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 
-                                                                'train_X.txt')
-    train_y = np.loadtxt(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 
-                                                                'train_y.txt')
+    # imported here because they load scikit-learn and matplotlib
+    with instrumentation.imports():
+        import feature_reduction
+        import model_registry
+        import bar_chart_graph as show_bar
+    train_path, test_path = feature_reduction.matrices_paths(features)
     
-    # load the class labels
-    labels_list = []
-    counter = 0
-    with open(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt') as class_labels:
-        for label in class_labels:
-            labels_list.append(label.replace('\n',''))
-            counter += 1
+    # load the training data
+    train_X_name = train_path + 'train_X'
+    train_y_name = train_path + 'train_y'
+    with instrumentation.stage('load'):
+        train_X = feature_store.load_matrix(train_X_name)
+        train_y = feature_store.load_matrix(train_y_name)
     
-    # select classifier
-    if classifier == 0:
-        clf = RandomForestClassifier(n_estimators = 100)
-    elif classifier == 1:
-        clf = ExtraTreesClassifier(n_estimators = 100)
-    else:
-        clf1 = RandomForestClassifier(n_estimators = 30)
-        clf2 = ExtraTreesClassifier(n_estimators = 30)
-        clf3 = SVC(kernel='rbf', probability=True)
-        clf = VotingClassifier(estimators=[('rf', clf1), ('et', clf2), 
-                                ('svc', clf3)], voting='soft', weights=[2,1,2])
+        # load the class labels
+        labels_list = load_labels()
     
-    # train the system
-    clf = clf.fit(train_X, train_y)
+    # train the system (or load it if it was already trained on this data)
+    with instrumentation.stage('model'):
+        clf = model_registry.get_model(classifier, train_X, train_y, 
+                                       [train_X_name, train_y_name])
     
-    # read the names of all the test data files
-    path = create_matrices.TEST_MATRICES_EXPORT_PATH + '*' #to select all files
-    test_files = glob.glob(path)
+    # read the names of all the test data matrices
+    path = test_path + '*' #to select all files
+    test_files = feature_store.list_matrices(path)
     
-    # dictionary to save the main theme for each country
+    # dictionary to save the main theme and its confidence for each country
     country_main_theme_dict = dict()
+    country_confidence_dict = dict()
     
-    # for each country in the list load the data predict them and output a graph
-    for country_filename in test_files:
-        country_name = country_filename.split('/')[1].split('_')[2].replace(
-                                                    '.txt', '').capitalize()
-        X_test = np.loadtxt(country_filename)
-        y_predict = clf.predict(X_test)
-        
-        # sum the image classes
-        country_classification = np.zeros([len(labels_list)])
-        for i in y_predict:
-            country_classification[i] += 1
-            
-        # save the main theme of the country to a dictionary
-        main_theme_indices = np.argwhere(country_classification == np.amax(
-                                                    country_classification))
-        if len(main_theme_indices) == 1:
-            country_main_theme_dict[country_name] = labels_list[main_theme_indices]
-        else:
-            # if more than 1 have same probability randomly pick one
-            random_selection = np.random.randint(len(main_theme_indices))
-            country_main_theme_dict[country_name] = labels_list[random_selection]
+    # bar charts to draw, drawn together after all the countries
+    charts = []
+    
+    # predict the images and aggregate their class probabilities to scores
+    aggregator = score_countries(clf, test_files, len(labels_list), mode, 
+                                 top_k, chunk_size, batched)
+    scores = aggregator.scores()
+    
+    # the highest score is the main theme, ties are broken by the scores of 
+    # the aggregator and not randomly
+    main_themes, confidences = aggregator.main_themes()
+    
+    # for each country in the list save its main theme and output a graph
+    for i, country_filename in enumerate(test_files):
+        country_name = os.path.basename(country_filename).split('_')[2]\
+                                                                .capitalize()
+        country_main_theme_dict[country_name] = labels_list[main_themes[i]]
+        country_confidence_dict[country_name] = confidences[i]
             
         # print a simple graph
-        show_bar.show_country_bar_chart(country_classification / 100, 
-                                                     labels_list, country_name)
+        charts.append((scores[i], labels_list, country_name))
+        
+    with instrumentation.stage('charts'):
+        rendered = show_bar.render_charts(charts, chart_workers)
+    instrumentation.count('charts_rendered', rendered)
         
     with open('country_main_themes.txt', 'w') as main_themes_file:
         for country in country_main_theme_dict:
             main_themes_file.write(country + ':' + 
                                     country_main_theme_dict[country] + '\n')
+            
+    with open(CONFIDENCE_FILENAME, 'w') as confidence_file:
+        for country in country_main_theme_dict:
+            confidence_file.write('%s:%s:%.4f\n' % (country, 
+                                  country_main_theme_dict[country], 
+                                  country_confidence_dict[country]))
 
-def test_accuracy(classifier=0):
+def test_accuracy(classifier=0, features=None, incremental=None,
+                  chunk_size=None):
     """
     This function loads the training data splits them into new training and
     test data and trains a machine learning classifier on the splitted training
     data. It then test the efficiency of the classifier on the splitted test 
-    data and prints the result.
+    data, prints the result and returns it. For a k-fold cross validation of
+    many classifiers and hyperparameters see accuracy_sweep.py.
     
     Parameters
     ----------
@@ -142,47 +284,80 @@ def test_accuracy(classifier=0):
                                 2) Etremely Randomized Trees Classifier with
                                     weight=1.
                                 3) Support Vector Machine with weight=2.
+                                
+    features : name of a feature configuration created by feature_reduction
+            (compact or reduced matrices). None uses the original matrices.
+            
+    incremental : training mode of incremental_training.py ('random_forest',
+            'extra_trees' or 'sgd'). The classifier is then trained out of
+            core, chunk by chunk, instead of on the whole split in memory.
+            
+    chunk_size : number of rows read at once by the incremental training.
     """
+    # imported here because they load scikit-learn
+    with instrumentation.imports():
+        import feature_reduction
+        import model_registry
+        try:
+            from sklearn.model_selection import train_test_split
+        except ImportError:
+            from sklearn.cross_validation import train_test_split
+    
     # load the training data
-    X = np.loadtxt(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X.txt')
-    y = np.loadtxt(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y.txt')
-    
-    # split the data
-    X_train, X_test, y_train, y_test = cross_validation.train_test_split( \
-    X, y, test_size=0.3, random_state=42)
-    
-    # train the system
-    # select classifier
-    if classifier == 0:
-        clf = RandomForestClassifier(n_estimators = 100)
-    elif classifier == 1:
-        clf = ExtraTreesClassifier(n_estimators = 100)
-    else:
-        clf1 = RandomForestClassifier(n_estimators = 30)
-        clf2 = ExtraTreesClassifier(n_estimators = 30)
-        clf3 = SVC(kernel='rbf', probability=True)
-        clf = VotingClassifier(estimators=[('rf', clf1), ('et', clf2), 
-                                ('svc', clf3)], voting='soft', weights=[2,1,2])
-                                
-    clf = clf.fit(X_train, y_train)
+    train_path = feature_reduction.matrices_paths(features)[0]
+    X_name = train_path + 'train_X'
+    y_name = train_path + 'train_y'
+    X = feature_store.load_matrix(X_name)
+    y = feature_store.load_matrix(y_name)
     
-    y_predict = clf.predict(X_test)
+    if incremental is not None:
+        with instrumentation.imports():
+            import incremental_training
+        # split the rows only, the training rows are read chunk by chunk
+        train_rows, test_rows = train_test_split( \
+        np.arange(len(y)), test_size=0.3, random_state=42)
+        clf = incremental_training.create_model(incremental)
+        clf = incremental_training.train_rows(clf, incremental, X, y,
+                        train_rows, np.arange(len(load_labels())),
+                        chunk_size or incremental_training.CHUNK_SIZE)
+        y_test = y[np.sort(test_rows)]
+        y_predict = clf.predict(X[np.sort(test_rows)])
+    else:
+        # split the data
+        X_train, X_test, y_train, y_test = train_test_split( \
+        X, y, test_size=0.3, random_state=42)
+        
+        # train the system (or load it if it was already trained on this 
+        # split)
+        clf = model_registry.get_model(classifier, X_train, y_train, 
+                        [X_name, y_name], 'test_size=0.3, random_state=42')
+        
+        y_predict = clf.predict(X_test)
     
     # verify accuracy
-    y_length = len(y_test)
-    counter = 0
-    for i in range(y_length):
-        if y_predict[i] == y_test[i]:
-            counter += 1
-            
-    print "Accuracy: ", counter * 100 / y_length, "%"
+    accuracy = np.mean(y_predict == y_test) * 100.
+    print('Accuracy: %s %%' % accuracy)
+    return accuracy
     
     
 def main():
-#    create_data()
+    parser = argparse.ArgumentParser(description='Classifies countries to '
+                                     'tourist themes.')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        help='time the stages and write a run report '
+                        '(timers, cprofile, tracemalloc)')
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(args.profile)
+        
+    with instrumentation.stage('create_data'):
+        create_data()
 #    test_accuracy(classifier=0)
-    classify_countries(classifier=0)
-    plot_world_map()
+    with instrumentation.stage('classify'):
+        classify_countries(classifier=0)
+    with instrumentation.stage('world_map'):
+        plot_world_map()
+    instrumentation.write_report()
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
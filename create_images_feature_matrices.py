@@ -6,7 +6,14 @@ Created on Tue May 17 18:20:02 2016
 
 This is a program that creates feature matrices for training and test data 
 images contained in the corresponding folders. The features used  are RGB and 
-HOG features.
+HOG features by default. Other feature sets (e.g. smaller RGB images, color 
+histograms, LBP) can be selected with --features, see feature_extractors.py.
+With --archives the images are read from tar or zip shards instead of the
+folders, see image_archives.py.
+
+Near-duplicate images of a theme or country (reposts, resized copies) are 
+skipped before their features are computed and listed in dedup_report.json, 
+see near_duplicates.py.
 
 Labels of the training data are the names of the folders that contain these
 images. Example: images in folder "beach" will be labelled as beach photos.
@@ -19,25 +26,227 @@ assuming that the folders names of countries are "visit_X" where X is the
 """
 
 import numpy as np
+import os
+import json
 import glob
+import argparse
+import multiprocessing
 from PIL import Image
-from skimage.feature import hog
+import feature_store
+import feature_extractors
+import near_duplicates
+import instrumentation
+from feature_cache import FeatureCache
 
 # size to resize images
 IMAGE_SIZE = 50
 
+# number of orientations of the HOG features
+HOG_ORIENTATIONS = 8
+
+# extractors of the features (see feature_extractors.py), the default is the
+# RGB values followed by the HOG features
+FEATURE_SET = 'rgb,hog:orientations=%d' % HOG_ORIENTATIONS
+
 # data paths
 TRAIN_DATA_PATH = 'train_data/*'
 TEST_DATA_PATH = 'test_data/*'
 
+# tar or zip shards of the train and test images (see image_archives.py)
+TRAIN_ARCHIVES_PATH = 'train_data_shards/*'
+TEST_ARCHIVES_PATH = 'test_data_shards/*'
+
 # paths to export deature matrices
 TRAIN_MATRICES_EXPORT_PATH = 'train_data_matrices/'
 TEST_MATRICES_EXPORT_PATH = 'test_data_matrices/'
 
-def create_train_data():
+# file next to the training matrices with the feature set and image size they
+# were created with
+FEATURE_SET_FILENAME = 'feature_set.json'
+
+def image_features(file_):
+    """
+    Loads an image, resizes it and returns its features: the flattened RGB
+    values followed by the HOG features.
+    """
+    # imported here because skimage is slow to import and only this reference
+    # implementation uses it (see batch_features.py)
+    from skimage.feature import hog
+    image_orig = Image.open(file_).resize([IMAGE_SIZE,IMAGE_SIZE])
+    image = np.array(image_orig)
+    hog_features = hog(np.array(image_orig.convert('L').resize([IMAGE_SIZE,
+                                    IMAGE_SIZE])), orientations=HOG_ORIENTATIONS)
+    return np.concatenate([image.flatten(), hog_features])
+
+def get_feature_set():
+    """
+    Returns the feature_extractors.FeatureSet of FEATURE_SET and IMAGE_SIZE.
+    """
+    return feature_extractors.FeatureSet(FEATURE_SET, IMAGE_SIZE)
+
+def save_feature_set():
+    """
+    Saves the description of the feature set and the image size of the 
+    matrices next to the training matrices.
+    """
+    with open(TRAIN_MATRICES_EXPORT_PATH + FEATURE_SET_FILENAME, 
+              'w') as feature_set_file:
+        json.dump(feature_parameters(), feature_set_file, indent=2, 
+                  sort_keys=True)
+
+def load_feature_set(path=TRAIN_MATRICES_EXPORT_PATH):
+    """
+    Returns the feature_extractors.FeatureSet that the matrices of a folder
+    were created with. Matrices created before the feature set was saved use
+    the default feature set.
+    """
+    if not os.path.exists(path + FEATURE_SET_FILENAME):
+        return get_feature_set()
+    with open(path + FEATURE_SET_FILENAME) as feature_set_file:
+        parameters = json.load(feature_set_file)
+    return feature_extractors.FeatureSet(parameters['features'], 
+                                         parameters['image_size'])
+
+def select_feature_set(features=None, image_size=None):
+    """
+    Selects the feature set and the image size of the matrices that are 
+    created next. If they are None the ones of the existing training matrices
+    are kept (see load_feature_set), so creating the matrices again never
+    changes their features unless asked for.
+    """
+    global FEATURE_SET, IMAGE_SIZE
+    saved = load_feature_set()
+    FEATURE_SET = saved.description() if features is None else features
+    IMAGE_SIZE = saved.image_size if image_size is None else image_size
+
+def feature_parameters():
+    """
+    Returns the parameters that the features depend on. Cached features are
+    only reused if they were computed with the same parameters.
+    """
+    return {'image_size' : IMAGE_SIZE, 
+            'features' : get_feature_set().description()}
+
+def features_size():
+    """
+    Returns the number of features of an image, as declared by the 
+    extractors of the feature set.
+    """
+    return get_feature_set().width()
+
+def fill_features_rows(args):
+    """
+    Computes the features of a list of images and writes them to the given
+    rows of a binary feature matrix. The matrix is opened from disk, so worker
+    processes write their rows straight into the output file. The images are
+    processed in batches by the extractors of the feature set.
+    
+    Parameters
+    ----------
+    args : tuple (matrix name, list of rows, list of image files, 
+            FeatureSet).
+    """
+    name, rows, files, feature_set = args
+    features_array = feature_store.open_matrix(name)
+    start = 0
+    for features in feature_set.iter_extract(files):
+        with instrumentation.stage('write'):
+            features_array[rows[start:start + len(features)]] = features
+        start += len(features)
+    with instrumentation.stage('write'):
+        features_array.flush()
+    del features_array
+
+def fill_features_rows_worker(args):
+    """
+    Runs fill_features_rows in a worker process and returns the measurements 
+    of the worker, so that the main process can add them to its own.
+    """
+    # forget the measurements copied from the main process
+    instrumentation.reset()
+    fill_features_rows(args)
+    return instrumentation.collect()
+
+def extract_features(files, name, workers=1, cache=None):
+    """
+    Fills a binary feature matrix with the features of a list of images. Row i 
+    of the matrix always contains the features of files[i], so the result is 
+    the same for any number of workers. Returns the number of images that were 
+    decoded (not found in the cache).
+    
+    Parameters
+    ----------
+    files : list of image files.
+    
+    name : name of an existing binary matrix with len(files) rows.
+    
+    workers : number of processes. With more than one, the images are split
+            in consecutive shards that are processed by a process pool.
+            
+    cache : FeatureCache. Features of cached images are copied from the cache
+            and only new or changed images are decoded.
+    """
+    rows = list(range(len(files)))
+    feature_set = get_feature_set()
+    
+    # copy the features of the cached images to their rows
+    if cache is not None:
+        with instrumentation.stage('cache_read'):
+            keys = [cache.key(file_) for file_ in files]
+            features_array = feature_store.open_matrix(name)
+            rows = []
+            for i in range(len(files)):
+                if cache.contains(keys[i]):
+                    features_array[i] = cache.load(keys[i])
+                else:
+                    rows.append(i)
+            features_array.flush()
+            del features_array
+        instrumentation.count('images_cached', len(files) - len(rows))
+    missing_files = [files[i] for i in rows]
+    
+    if workers > 1 and len(rows) > 1:
+        # a few shards per worker so that slow shards do not leave cores idle
+        shards_number = min(len(rows), workers * 4)
+        bounds = np.linspace(0, len(rows), shards_number + 1).astype(int)
+        shards = [(name, rows[bounds[i]:bounds[i + 1]], 
+                   missing_files[bounds[i]:bounds[i + 1]], feature_set) 
+                                            for i in range(shards_number)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            for measurements in pool.map(fill_features_rows_worker, shards, 
+                                         chunksize=1):
+                instrumentation.merge(measurements)
+        finally:
+            pool.close()
+            pool.join()
+    elif rows:
+        fill_features_rows((name, rows, missing_files, feature_set))
+        
+    # add the new features to the cache
+    if cache is not None and rows:
+        with instrumentation.stage('cache_write'):
+            features_array = feature_store.load_matrix(name)
+            for i in rows:
+                cache.save(keys[i], features_array[i])
+            del features_array
+        
+    return len(rows)
+
+def create_train_data(workers=1, cache=None, index=None):
     """
     Loads the train images and creates the features matrices required for the 
-    training. Exports the train_X and train_y in seperate txt files.
+    training. Exports the train_X and train_y in seperate binary matrices.
+    Returns the number of decoded images.
+    
+    Parameters
+    ----------
+    workers : number of processes used to compute the features.
+    
+    cache : FeatureCache to reuse the features of unchanged images.
+    
+    index : near_duplicates.DuplicateIndex. The near duplicates of the
+            images of a theme are skipped.
     """
     # get folder names for the train data (themes)
     path = TRAIN_DATA_PATH
@@ -58,53 +267,64 @@ def create_train_data():
     for i in range(len(folders)):
         filenames[folders[i].split('/')[1]] = glob.glob(folders[i] + '/*')
         
+    # skip the near duplicates before any feature is computed
+    if index is not None:
+        for theme in filenames:
+            filenames[theme] = index.unique_files(theme, filenames[theme])
         
-    # count number of images to create numpy array
-    file_counter = 0
+    # put all the images in one list, the position of an image in this list is
+    # its row in the feature matrix
+    files_list = []
     for theme in filenames:
-        file_counter += len(filenames[theme])
+        files_list.extend(filenames[theme])
+    file_counter = len(files_list)
+    if file_counter == 0:
+        print('No train images found in ' + TRAIN_DATA_PATH)
+        return 0
         
-    # get sample hog features for an image to know the hog features matrix size
-    file_temp = filenames[filenames.keys()[0]][0]
-    hog_features_size = len(hog(np.array(Image.open(file_temp)\
-            .convert('L').resize([IMAGE_SIZE,IMAGE_SIZE])), orientations=8))
+    # the extractors declare the size of the features matrix
+    features_number = features_size()
         
-    # create numpy array for the features and class array
-    features_array = np.zeros([file_counter, IMAGE_SIZE * IMAGE_SIZE * 3 + 
-                                                            hog_features_size])
-    class_array = np.zeros([file_counter])
-    
-    # Load each image, resize, flatten and save it in a list. Also, in a 
-    # seperate list save the class of each image. HOG features are also added.
-    counter = 0
-    for theme in filenames:
-        for file_ in filenames[theme]:
-            image_orig = Image.open(file_).resize([IMAGE_SIZE,IMAGE_SIZE])
-            image = np.array(image_orig)
-            features_array[counter, :IMAGE_SIZE * IMAGE_SIZE * 3] = \
-                                                        image.flatten()[:]
-            features_array[counter, IMAGE_SIZE * IMAGE_SIZE * 3:] = \
-                hog(np.array(image_orig.convert('L').resize([IMAGE_SIZE,
-                                                 IMAGE_SIZE])), orientations=8)
-            class_array[counter] = themes_dict[file_.split('/')[1]]
-            counter += 1
-            
-    # save the feature arrays to files
-    np.savetxt(TRAIN_MATRICES_EXPORT_PATH + 'train_X.txt', features_array)
-    np.savetxt(TRAIN_MATRICES_EXPORT_PATH + 'train_y.txt', class_array)
+    # create the binary matrices for the features and classes on disk
+    features_array = feature_store.create_matrix(TRAIN_MATRICES_EXPORT_PATH + 
+                                'train_X', [file_counter, features_number])
+    del features_array
+    class_array = feature_store.create_matrix(TRAIN_MATRICES_EXPORT_PATH + 
+                'train_y', [file_counter], dtype=feature_store.LABELS_DTYPE)
+    
+    # save the class of each image. The class is the folder of the image.
+    for counter in range(file_counter):
+        class_array[counter] = themes_dict[files_list[counter].split('/')[1]]
+    class_array.flush()
+    
+    # Load each image, resize, flatten and save its RGB and HOG features.
+    decoded = extract_features(files_list, TRAIN_MATRICES_EXPORT_PATH + 
+                                                'train_X', workers, cache)
     
     # save class themes to file
     with open(TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt', 'w') as class_file:
         for i in range(len(class_themes.keys())):
             class_file.write(class_themes[i] + '\n')
-    
+    save_feature_set()
+            
+    return decoded
 
 
-def create_test_data():
+def create_test_data(workers=1, cache=None, index=None):
     """
     For every country loads the test images and creates a feature matrix to
-    test using any ML approach. Exports a train_x_<country name>.txt file with
-    these features for every country.
+    test using any ML approach. Exports a test_X_<country name> binary matrix
+    with these features for every country. Returns the number of decoded 
+    images.
+    
+    Parameters
+    ----------
+    workers : number of processes used to compute the features.
+    
+    cache : FeatureCache to reuse the features of unchanged images.
+    
+    index : near_duplicates.DuplicateIndex. The near duplicates of the
+            images of a country are skipped.
     """
     # get folder names for the test data (countries)
     path = TEST_DATA_PATH
@@ -114,39 +334,132 @@ def create_test_data():
     # images
     countries_dict = dict()
     for i in range(len(folders)):
-        countries_dict[folders[i].split('/')[1].split('_')[1]] = glob.glob(
-                                                            folders[i] + '/*')
+        files = glob.glob(folders[i] + '/*')
+        # skip the near duplicates before any feature is computed
+        if index is not None:
+            files = index.unique_files(folders[i].split('/')[1], files)
+        countries_dict[folders[i].split('/')[1].split('_')[1]] = files
         
-    # get sample hog features for an image to know the hog features matrix size
-    file_temp = countries_dict[countries_dict.keys()[0]][0]
-    hog_features_size = len(hog(np.array(Image.open(file_temp)\
-            .convert('L').resize([IMAGE_SIZE,IMAGE_SIZE])), orientations=8))    
+    # drop countries without images
+    for country in list(countries_dict.keys()):
+        if not countries_dict[country]:
+            del countries_dict[country]
+    if not countries_dict:
+        print('No test images found in ' + TEST_DATA_PATH)
+        return 0
+        
+    # the extractors declare the size of the features matrix
+    features_number = features_size()
     
     # for every country create a feature matrix and save it
+    decoded = 0
     for country in countries_dict:
-        # create an array to store all features
-        country_features = np.zeros([len(countries_dict[country]),\
-            IMAGE_SIZE * IMAGE_SIZE * 3 + hog_features_size])
+        # create a binary matrix on disk to store all features
+        name = TEST_MATRICES_EXPORT_PATH + 'test_X_' + country
+        country_features = feature_store.create_matrix(name, 
+                            [len(countries_dict[country]), features_number])
+        del country_features
         
         # for every country fill the features array 
-        counter = 0
-        for file_ in countries_dict[country]:
-            image_orig = Image.open(file_).resize([IMAGE_SIZE,IMAGE_SIZE])
-            image = np.array(image_orig)
-            country_features[counter, :IMAGE_SIZE * IMAGE_SIZE * 3] = \
-                                                            image.flatten()[:]
-            country_features[counter, IMAGE_SIZE * IMAGE_SIZE * 3:] = \
-                hog(np.array(image_orig.convert('L').resize([IMAGE_SIZE,
-                                             IMAGE_SIZE])), orientations=8)
-            counter += 1
+        decoded += extract_features(countries_dict[country], name, workers,
+                                                                      cache)
         
-        # save the array to file
-        np.savetxt(TEST_MATRICES_EXPORT_PATH + 'test_X_' + country + '.txt', 
-                                                           country_features)
+    return decoded
+
+def create_data(workers=1, use_cache=True, dedup=True, features=None,
+                image_size=None):
+    """
+    Creates the feature matrices of the train and the test images. Returns the
+    number of decoded images and the number of removed cache entries.
+    
+    Parameters
+    ----------
+    workers : number of processes used to compute the features.
+    
+    use_cache : if True only new or changed images are decoded and the 
+            features of the other images are read from the feature cache.
+            
+    dedup : if True the near duplicates of every theme and country are 
+            skipped and reported to near_duplicates.DEDUP_REPORT_FILENAME.
+            
+    features, image_size : feature set and image size (see 
+            select_feature_set). None keeps the ones of the existing matrices.
+    """
+    select_feature_set(features, image_size)
+    cache = None
+    if use_cache:
+        cache = FeatureCache(feature_parameters())
+    index = None
+    if dedup:
+        index = near_duplicates.DuplicateIndex(cache=cache)
+        
+    with instrumentation.stage('train'):
+        decoded = create_train_data(workers, cache, index)
+    train_keys = 0 if cache is None else len(cache.used_keys)
+    with instrumentation.stage('test'):
+        decoded += create_test_data(workers, cache, index)
+    if index is not None:
+        index.write_report()
+    
+    # remove the cached features of deleted images. If the train or the test
+    # images were not found, the entries of their images are kept.
+    removed = 0
+    if cache is not None and 0 < train_keys < len(cache.used_keys):
+        with instrumentation.stage('cache_prune'):
+            removed = cache.prune()
+    if cache is not None:
+        cache.save_dhashes()
+    return decoded, removed
 
 def main():
-    create_train_data()
-    create_test_data()
+    parser = argparse.ArgumentParser(description='Creates the feature '
+                                    'matrices of the train and test images.')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='number of processes computing the features '
+                        '(0 uses all the cores)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='compute the features of all the images instead '
+                        'of reusing the cached features of unchanged images')
+    parser.add_argument('--features',
+                        help='feature set, e.g. "rgb:size=25,color_hist,lbp" '
+                        '(see feature_extractors.py), by default the one of '
+                        'the existing matrices or "%s"' % FEATURE_SET)
+    parser.add_argument('--image-size', type=int,
+                        help='size the images are resized to, by default the '
+                        'one of the existing matrices or %d' % IMAGE_SIZE)
+    parser.add_argument('--stream', action='store_true',
+                        help='use the streaming pipeline of streaming_ingest '
+                        'with bounded queues (for very large image folders)')
+    parser.add_argument('--archives', action='store_true',
+                        help='read the images from the tar or zip shards of '
+                        'TRAIN_ARCHIVES_PATH and TEST_ARCHIVES_PATH (uses '
+                        'the streaming pipeline)')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='keep the near duplicate images')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        help='time the stages and write a run report '
+                        '(timers, cprofile, tracemalloc)')
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(args.profile)
+        
+    workers = args.workers
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+        
+    with instrumentation.stage('extract'):
+        if args.stream or args.archives:
+            # imported here because streaming_ingest uses this module
+            import streaming_ingest
+            decoded, removed = streaming_ingest.create_data(workers, 
+                        not args.no_cache, args.archives, not args.no_dedup,
+                        args.features, args.image_size)
+        else:
+            decoded, removed = create_data(workers, not args.no_cache, 
+                        not args.no_dedup, args.features, args.image_size)
+    print('Computed the features of %d new or changed images' % decoded)
+    print('Removed %d old entries from the feature cache' % removed)
+    instrumentation.write_report()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
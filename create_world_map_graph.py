@@ -7,7 +7,18 @@ Created on Thu May 19 21:57:43 2016
 This is a program that creates a world map where each tested country is colored
 to its best matching tourist theme and the rest countries are colored grey.
 
-REQUIREMENTS: cartopy, iso3166 python packages must be installed.
+The country geometries are read from the Natural Earth shapefile only once:
+they are projected to PlateCarree and saved as vertex arrays indexed by their
+adm0_a3 code in WORLD_MAP_CACHE_PATH, together with a pre-rendered background
+(land and ocean). A new map only recolors the country patches of this base
+layer, and within one process the figure itself is reused.
+
+REQUIREMENTS: iso3166 python package must be installed. cartopy is only needed
+to build the base layer.
+
+This program can run indepedently:
+    python create_world_map_graph.py
+    python create_world_map_graph.py --rebuild
 """
 
 #==============================================================================
@@ -16,15 +27,39 @@ REQUIREMENTS: cartopy, iso3166 python packages must be installed.
 # http://stackoverflow.com/questions/35423366/change-map-boundary-color-in-cartopy
 #==============================================================================
 
+import os
+import argparse
 import iso3166
-import matplotlib.pyplot as plt
-import cartopy
-import cartopy.io.shapereader as shpreader
-import cartopy.crs as ccrs
 import numpy as np
 import colorsys
 import matplotlib.patches as mpatches
+import matplotlib.image as mimage
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.colors import to_rgba
+from matplotlib.path import Path
 import create_images_feature_matrices as create_matrices
+import instrumentation
+
+# folder of the cached base layer
+WORLD_MAP_CACHE_PATH = 'world_map_cache/'
+
+# resolution of the Natural Earth countries
+RESOLUTION = '110m'
+
+# size (in inches) and resolution of the pre-rendered background
+BACKGROUND_SIZE = (20, 10)
+BACKGROUND_DPI = 100
+
+# visible part of the world (longitudes and latitudes)
+MAP_EXTENT = [-150, 60, -25, 60]
+
+# color of the countries that were not tested
+NOT_TESTED_COLOR = (0.3, 0.3, 0.3)
+
+# world map of the current process, reused by every create_world_map() call
+_world_map = None
 
 #==============================================================================
 # code from: http://stackoverflow.com/questions/470690/how-to-automatically-generate-n-distinct-colors
@@ -39,6 +74,163 @@ def get_colors(num_colors):
     return colors
 #==============================================================================
 
+def layer_path(resolution=RESOLUTION):
+    return os.path.join(WORLD_MAP_CACHE_PATH, 'countries_' + resolution + 
+                                                                    '.npz')
+
+def background_path(resolution=RESOLUTION):
+    return os.path.join(WORLD_MAP_CACHE_PATH, 'background_' + resolution + 
+                                                                    '.png')
+
+def geometry_path(geometry):
+    """
+    Returns the vertices and the path codes of all the polygons of a 
+    geometry.
+    """
+    vertices = []
+    codes = []
+    for polygon in getattr(geometry, 'geoms', [geometry]):
+        if polygon.is_empty:
+            continue
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            ring = np.asarray(ring.coords)[:, :2]
+            ring_codes = np.empty(len(ring), dtype=Path.code_type)
+            ring_codes.fill(Path.LINETO)
+            ring_codes[0] = Path.MOVETO
+            ring_codes[-1] = Path.CLOSEPOLY
+            vertices.append(ring)
+            codes.append(ring_codes)
+    if not vertices:
+        return np.zeros([0, 2]), np.zeros([0], dtype=Path.code_type)
+    return np.concatenate(vertices), np.concatenate(codes)
+
+def build_base_layer(resolution=RESOLUTION):
+    """
+    Reads the countries of the Natural Earth shapefile, projects them to 
+    PlateCarree and saves their vertices indexed by adm0_a3. Also renders the
+    background (land and ocean) of the map.
+    """
+    # only needed to build the base layer
+    import cartopy
+    import cartopy.io.shapereader as shpreader
+    import cartopy.crs as ccrs
+    
+    if not os.path.isdir(WORLD_MAP_CACHE_PATH):
+        os.makedirs(WORLD_MAP_CACHE_PATH)
+    projection = ccrs.PlateCarree()
+    shpf = shpreader.natural_earth(resolution=resolution, category='cultural', 
+                                                   name='admin_0_countries')
+    
+    # the paths of all the countries are stored one after the other, the
+    # offsets give the first vertex of every country
+    countries_codes = []
+    offsets = [0]
+    vertices = []
+    path_codes = []
+    for country in shpreader.Reader(shpf).records():
+        geometry = projection.project_geometry(country.geometry, projection)
+        country_vertices, country_codes = geometry_path(geometry)
+        countries_codes.append(country.attributes['adm0_a3'])
+        offsets.append(offsets[-1] + len(country_vertices))
+        vertices.append(country_vertices)
+        path_codes.append(country_codes)
+    np.savez(layer_path(resolution), adm0_a3=np.array(countries_codes), 
+             offsets=np.array(offsets, dtype=np.int64),
+             vertices=np.concatenate(vertices).astype(np.float32),
+             codes=np.concatenate(path_codes))
+    
+    # render the land and the ocean of the whole world
+    fig = Figure(figsize=BACKGROUND_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1], projection=projection)
+    ax.add_feature(cartopy.feature.LAND, linewidth=0.5, edgecolor='white')
+    ax.add_feature(cartopy.feature.OCEAN)
+    ax.set_global()
+    ax.set_axis_off()
+    fig.savefig(background_path(resolution), dpi=BACKGROUND_DPI)
+
+def load_base_layer(resolution=RESOLUTION):
+    """
+    Returns the adm0_a3 codes and the matplotlib paths of all the countries. 
+    The base layer is built if it is not cached.
+    """
+    if not (os.path.exists(layer_path(resolution)) and 
+            os.path.exists(background_path(resolution))):
+        build_base_layer(resolution)
+    layer = np.load(layer_path(resolution))
+    offsets = layer['offsets']
+    vertices = layer['vertices']
+    codes = layer['codes']
+    paths = [Path(vertices[offsets[i]:offsets[i + 1]], 
+                  codes[offsets[i]:offsets[i + 1]]) 
+                                            for i in range(len(offsets) - 1)]
+    return [str(code) for code in layer['adm0_a3']], paths
+
+class WorldMap(object):
+    """
+    A world map figure drawn from the cached base layer. Every country is a
+    patch of one collection, so coloring the map for a new classification 
+    only changes the face colors of the collection.
+    
+    Parameters
+    ----------
+    resolution : resolution of the Natural Earth countries.
+    """
+    def __init__(self, resolution=RESOLUTION):
+        countries_codes, paths = load_base_layer(resolution)
+        self.index = dict((code, i) for i, code in enumerate(countries_codes))
+        
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+        self.ax.imshow(mimage.imread(background_path(resolution)), 
+                       extent=[-180, 180, -90, 90], interpolation='bilinear')
+        self.countries = PathCollection(paths, facecolors=NOT_TESTED_COLOR,
+                                        linewidths=0.5, edgecolors='white')
+        self.ax.add_collection(self.countries)
+        self.ax.set_xlim(MAP_EXTENT[0], MAP_EXTENT[1])
+        self.ax.set_ylim(MAP_EXTENT[2], MAP_EXTENT[3])
+        self.ax.set_aspect('equal')
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        self.ax.set_title('World map of countries colored in main tourist '
+                          'theme')
+        self.legend = None
+        
+    def recolor(self, country_colors):
+        """
+        Colors the countries of a dictionary {adm0_a3 code : color} and the 
+        rest in NOT_TESTED_COLOR.
+        """
+        facecolors = np.tile(to_rgba(NOT_TESTED_COLOR), [len(self.index), 1])
+        for code in country_colors:
+            if code in self.index:
+                facecolors[self.index[code]] = to_rgba(country_colors[code])
+        self.countries.set_facecolors(facecolors)
+        
+    def set_legend(self, colors, labels):
+        if self.legend is not None:
+            self.legend.remove()
+        handles = [mpatches.Rectangle((0, 0), 1, 1, facecolor=color) 
+                                                        for color in colors]
+        ncol = 4
+        self.legend = self.ax.legend(handles, labels,
+                   loc='lower left', bbox_to_anchor=(0.025, -0.3), 
+                    fancybox=True, prop={'size':6}, ncol=ncol)
+        
+    def save(self, filename):
+        self.figure.savefig(filename, format='png', dpi=200, 
+                                                        bbox_inches='tight')
+
+def get_world_map():
+    """
+    Returns the world map of the current process, created on the first call.
+    """
+    global _world_map
+    if _world_map is None:
+        _world_map = WorldMap()
+    return _world_map
+
 def create_world_map():
     """
     This function reads all the data for the countries concerning the main
@@ -54,12 +246,10 @@ def create_world_map():
     
     # read all the themes list
     themes_list = []
-    counter = 0
     with open(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt')\
                                                             as class_labels:
         for theme in class_labels:
             themes_list.append(theme.replace('\n',''))
-            counter += 1
     
     # get unique color for each theme
     color_list = get_colors(len(themes_list))
@@ -69,74 +259,41 @@ def create_world_map():
     for i in range(len(themes_list)):
         theme_color[themes_list[i]] = color_list[i]
         
-    # create a mapping between country name and its ISO 3-digit code
-    countries_name_dict = dict()
+    # map the ISO 3-digit code of every country to the color of its theme
+    country_colors = dict()
     for country in countries_theme_dict:
         # filter out any name mismatch
         try:
             country_code = iso3166.countries_by_name[country.upper()][2]
-            countries_name_dict[country_code] = country
+            country_colors[country_code] = theme_color[
+                                                countries_theme_dict[country]]
         except KeyError:
 #            print country
             pass
     
-    # create the world map
-    fig = plt.Figure()
-    fig.set_canvas(plt.gcf().canvas)
-    
-    ax = plt.axes(projection=ccrs.PlateCarree())
-    ax.add_feature(cartopy.feature.LAND, linewidth=0.5, edgecolor='white')
-    ax.add_feature(cartopy.feature.OCEAN)
-    ax.set_extent([-150,60,-25,60])
-    
-    shpf = shpreader.natural_earth(resolution='110m', category='cultural', 
-                                                   name='admin_0_countries')
-    
-    reader = shpreader.Reader(shpf)
-    countries = reader.records()
-    
-    for country in countries:
-        if country.attributes['adm0_a3'] in countries_name_dict.keys():
-            ax.add_geometries(country.geometry, ccrs.PlateCarree(),
-                              facecolor=theme_color[
-                                  countries_theme_dict[
-                                      countries_name_dict[
-                                          country.attributes['adm0_a3']]]],
-                              linewidth=0.5, edgecolor='white', 
-                              label=country.attributes['adm0_a3'])
-        else:
-            ax.add_geometries(country.geometry, ccrs.PlateCarree(),
-                              facecolor=(0.3,0.3,0.3),
-                              linewidth=0.5, edgecolor='white', 
-                              label=country.attributes['adm0_a3'])
-    
-    plt.title('World map of countries colored in main tourist theme')
+    # color the cached world map
+    with instrumentation.stage('base_layer'):
+        world_map = get_world_map()
+    world_map.recolor(country_colors)
     
     # === create the legend ===
-    # create list with rectangle colors for the legend
-    legend_color_list = []
-    for color in  color_list:
-        temp = mpatches.Rectangle((0, 0), 1, 1, facecolor=color)
-        legend_color_list.append(temp)
-    legend_color_list.append(mpatches.Rectangle((0, 0), 1, 1, 
-                                                facecolor=(0.3,0.3,0.3)))
-    
-    # create labels for the legend
-    legend_labels_list = []
-    for theme in themes_list:
-        legend_labels_list.append(theme)
-    legend_labels_list.append('not tested')
-        
-    ncol = 4
-    plt.legend(legend_color_list, legend_labels_list,
-                   loc='lower left', bbox_to_anchor=(0.025, -0.3), 
-                    fancybox=True, prop={'size':6}, ncol=ncol)              
+    world_map.set_legend(color_list + [NOT_TESTED_COLOR], 
+                         themes_list + ['not tested'])
     
     # save figure to file
-    fig.savefig("world_map.png", format='png', dpi=200, bbox_inches='tight')
+    with instrumentation.stage('save'):
+        world_map.save("world_map.png")
     
 def main():
+    parser = argparse.ArgumentParser(description='Creates the world map of '
+                                     'the main tourist themes.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='read the shapefile and build the cached base '
+                        'layer again')
+    args = parser.parse_args()
+    if args.rebuild:
+        build_base_layer()
     create_world_map()
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
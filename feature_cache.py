@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper script that caches the features of every image on disk, so
+that the feature matrices can be recreated without decoding all the images
+again.
+
+An entry of the cache is keyed by the hash of the content of the image file and
+by the extraction parameters (image size, HOG orientations etc.). A renamed
+image is therefore still found in the cache, while a changed image or changed
+parameters create a new entry. Entries of images that no longer exist are
+removed by prune().
+
+The cache also keeps the difference hash of every image (see
+near_duplicates.py) by the hash of its content, in one file (DHASH_FILENAME),
+so unchanged images are not decoded again to find their near duplicates.
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import numpy as np
+import feature_store
+
+# folder of the cache
+FEATURE_CACHE_PATH = 'feature_cache/'
+
+# size of the blocks that the image files are read in for hashing
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# file of the cache with the difference hashes of the images
+DHASH_FILENAME = 'dhashes.json'
+
+def file_hash(file_):
+    """
+    Returns the SHA-1 hash of the content of a file.
+    """
+    sha = hashlib.sha1()
+    with open(file_, 'rb') as image_file:
+        block = image_file.read(HASH_BLOCK_SIZE)
+        while block:
+            sha.update(block)
+            block = image_file.read(HASH_BLOCK_SIZE)
+    return sha.hexdigest()
+
+class FeatureCache(object):
+    """
+    Per image feature cache.
+
+    Parameters
+    ----------
+    parameters : dictionary with the feature extraction parameters. Entries
+            created with different parameters are never mixed.
+
+    folder : folder of the cache.
+    """
+    def __init__(self, parameters, folder=FEATURE_CACHE_PATH):
+        self.folder = folder
+        self.parameters = ';'.join('%s=%s' % (key, parameters[key])
+                                   for key in sorted(parameters))
+        # keys of the entries used since the cache was created
+        self.used_keys = set()
+        # content hashes of the images used since the cache was created
+        self.used_hashes = set()
+        # content hashes of the image files, so every file is read only once
+        self.file_hashes = dict()
+        # difference hashes by content hash, loaded when they are first used
+        self.dhashes = None
+
+    def content_hash(self, file_):
+        """
+        Returns the hash of the content of an image file.
+        """
+        if file_ not in self.file_hashes:
+            self.file_hashes[file_] = file_hash(file_)
+        return self.file_hashes[file_]
+
+    def key(self, file_):
+        """
+        Returns the cache key of an image file.
+        """
+        return self.hash_key(self.content_hash(file_))
+
+    def data_key(self, data):
+        """
+        Returns the cache key of the content (bytes) of an image file that was
+        already read.
+        """
+        return self.hash_key(hashlib.sha1(data).hexdigest())
+
+    def hash_key(self, content_hash):
+        self.used_hashes.add(content_hash)
+        sha = hashlib.sha1()
+        sha.update(content_hash.encode('ascii'))
+        sha.update(self.parameters.encode('ascii'))
+        key = sha.hexdigest()
+        self.used_keys.add(key)
+        return key
+
+    def entry_path(self, key):
+        # entries are spread in subfolders to keep the folders small
+        return os.path.join(self.folder, key[:2], key +
+                                            feature_store.MATRIX_EXTENSION)
+
+    def contains(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def load(self, key):
+        """
+        Returns the cached features of an entry.
+        """
+        return np.load(self.entry_path(key))
+
+    def save(self, key, features):
+        """
+        Saves the features of an image to the cache.
+        """
+        path = self.entry_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # write to a temporary file first so that an interrupted run never
+        # leaves a broken entry behind
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as entry_file:
+            np.save(entry_file, np.asarray(features,
+                                           dtype=feature_store.FEATURES_DTYPE))
+        os.rename(temp_path, path)
+
+    def dhashes_path(self):
+        return os.path.join(self.folder, DHASH_FILENAME)
+
+    def load_dhashes(self):
+        if self.dhashes is None:
+            try:
+                with open(self.dhashes_path()) as dhashes_file:
+                    self.dhashes = json.load(dhashes_file)
+            except (IOError, ValueError):
+                self.dhashes = dict()
+        return self.dhashes
+
+    def load_dhash(self, content_hash):
+        """
+        Returns the cached difference hash of an image or None.
+        """
+        self.used_hashes.add(content_hash)
+        return self.load_dhashes().get(content_hash)
+
+    def save_dhash(self, content_hash, dhash):
+        """
+        Adds the difference hash of an image to the cache. The hashes are
+        written to disk by save_dhashes().
+        """
+        self.used_hashes.add(content_hash)
+        self.load_dhashes()[content_hash] = dhash
+
+    def save_dhashes(self):
+        """
+        Writes the difference hashes to disk, if any was used.
+        """
+        if self.dhashes is None:
+            return
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        temp_path = self.dhashes_path() + '.tmp'
+        with open(temp_path, 'w') as dhashes_file:
+            json.dump(self.dhashes, dhashes_file)
+        os.rename(temp_path, self.dhashes_path())
+
+    def prune(self):
+        """
+        Removes all the entries that were not used since the cache was created,
+        i.e. the entries of deleted or changed images and of old parameters.
+        Nothing is removed if no entry was used, e.g. when no image was found.
+        The difference hashes of images that were not used are dropped too.
+        Returns the number of removed entries.
+        """
+        if not os.path.isdir(self.folder) or not self.used_keys:
+            return 0
+        dhashes = self.load_dhashes()
+        for content_hash in list(dhashes.keys()):
+            if content_hash not in self.used_hashes:
+                del dhashes[content_hash]
+        self.save_dhashes()
+        removed = 0
+        for subfolder in os.listdir(self.folder):
+            subfolder_path = os.path.join(self.folder, subfolder)
+            if not os.path.isdir(subfolder_path):
+                continue
+            for entry in os.listdir(subfolder_path):
+                key = entry.split('.')[0]
+                if key not in self.used_keys:
+                    os.remove(os.path.join(subfolder_path, entry))
+                    removed += 1
+            if not os.listdir(subfolder_path):
+                os.rmdir(subfolder_path)
+        return removed
+
+    def clear(self):
+        """
+        Removes the whole cache.
+        """
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+        self.used_keys = set()
+        self.used_hashes = set()
+        self.dhashes = None
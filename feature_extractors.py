@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper script with a registry of feature extractors. A feature set
+is a list of extractors whose outputs are concatenated, e.g. the default set
+of create_images_feature_matrices.py is the raw RGB values followed by the HOG
+features:
+
+    rgb,hog:orientations=8
+
+Extractors:
+    rgb        : raw RGB values, optionally resized (size=<pixels>).
+    hog        : HOG features (orientations, pixels_per_cell, cells_per_block).
+    color_hist : normalized histogram of every color channel (bins).
+    lbp        : normalized histogram of the local binary patterns of the
+                 grayscale image (radius).
+
+Every extractor declares the width of its output for a given image size, so
+the size of a feature matrix is known before any image is decoded. Every
+image is decoded and resized once and converted to grayscale once, and all
+the extractors of the set work on these arrays batch by batch.
+
+New extractors are added with register_extractor().
+"""
+
+import numpy as np
+from PIL import Image
+import batch_features
+import instrumentation
+
+# extractors by name
+EXTRACTORS = dict()
+
+def register_extractor(name, extractor_class):
+    """
+    Adds an extractor class to the registry.
+    """
+    extractor_class.name = name
+    EXTRACTORS[name] = extractor_class
+
+class FeatureExtractor(object):
+    """
+    Base class of the extractors. An extractor is created with its parameters
+    as keyword arguments.
+    """
+    name = None
+
+    def __init__(self, **parameters):
+        self.parameters = parameters
+
+    def width(self, image_size):
+        """
+        Returns the number of features of an image of image_size pixels.
+        """
+        raise NotImplementedError
+
+    def extract(self, images, gray):
+        """
+        Returns the (N, width) features of a batch of images.
+
+        Parameters
+        ----------
+        images : (N, image_size, image_size, 3) uint8 array of RGB images.
+
+        gray : (N, image_size, image_size) uint8 array of the same images in
+                grayscale.
+        """
+        raise NotImplementedError
+
+    def description(self):
+        return self.name + ''.join(':%s=%s' % (key, self.parameters[key])
+                                   for key in sorted(self.parameters))
+
+class RGBExtractor(FeatureExtractor):
+    """
+    Raw RGB values. Parameters: size (default the image size).
+    """
+    def __init__(self, size=None):
+        FeatureExtractor.__init__(self, **({} if size is None else
+                                           {'size' : size}))
+        self.size = size
+
+    def width(self, image_size):
+        size = self.size or image_size
+        return size * size * 3
+
+    def extract(self, images, gray):
+        if self.size is None or self.size == images.shape[1]:
+            return images.reshape([len(images), -1])
+        # resized from the decoded array, the file is not decoded again
+        return np.array([np.asarray(Image.fromarray(image).resize(
+                            [self.size, self.size])) for image in images]
+                        ).reshape([len(images), -1])
+
+class HOGExtractor(FeatureExtractor):
+    """
+    HOG features with 'L2-Hys' block normalization. Parameters: orientations,
+    pixels_per_cell and cells_per_block.
+    """
+    def __init__(self, orientations=8,
+                 pixels_per_cell=batch_features.HOG_PIXELS_PER_CELL,
+                 cells_per_block=batch_features.HOG_CELLS_PER_BLOCK):
+        FeatureExtractor.__init__(self, orientations=orientations,
+                                  pixels_per_cell=pixels_per_cell,
+                                  cells_per_block=cells_per_block)
+        self.orientations = orientations
+        self.pixels_per_cell = pixels_per_cell
+        self.cells_per_block = cells_per_block
+
+    def width(self, image_size):
+        blocks = max(0, image_size // self.pixels_per_cell -
+                        self.cells_per_block + 1)
+        return (blocks * blocks * self.cells_per_block *
+                self.cells_per_block * self.orientations)
+
+    def extract(self, images, gray):
+        return batch_features.batch_hog(gray, self.orientations,
+                                        self.pixels_per_cell,
+                                        self.cells_per_block)
+
+class ColorHistogramExtractor(FeatureExtractor):
+    """
+    Histogram of every color channel, normalized by the number of pixels.
+    Parameters: bins.
+    """
+    def __init__(self, bins=8):
+        FeatureExtractor.__init__(self, bins=bins)
+        self.bins = bins
+
+    def width(self, image_size):
+        return 3 * self.bins
+
+    def extract(self, images, gray):
+        number = len(images)
+        pixels = images.reshape([number, -1, 3])
+        bins = pixels.astype(np.intp) * self.bins // 256
+        # one bincount for the histograms of all the images and channels
+        index = ((np.arange(number)[:, np.newaxis, np.newaxis] * 3 +
+                  np.arange(3)[np.newaxis, np.newaxis, :]) * self.bins + bins)
+        histogram = np.bincount(index.ravel(),
+                                minlength=number * 3 * self.bins)
+        return histogram.reshape([number, -1]) / float(pixels.shape[1])
+
+class LBPExtractor(FeatureExtractor):
+    """
+    Histogram of the 8 neighbour local binary patterns of the grayscale image
+    (256 patterns), normalized by the number of pixels. Parameters: radius
+    (distance in pixels of the neighbours).
+    """
+    def __init__(self, radius=1):
+        FeatureExtractor.__init__(self, radius=radius)
+        self.radius = radius
+
+    def width(self, image_size):
+        return 256
+
+    def extract(self, images, gray):
+        number, rows, columns = gray.shape
+        r = self.radius
+        center = gray[:, r:rows - r, r:columns - r]
+        codes = np.zeros(center.shape, dtype=np.intp)
+        neighbours = [(-r, -r), (-r, 0), (-r, r), (0, r), (r, r), (r, 0),
+                      (r, -r), (0, -r)]
+        for bit in range(len(neighbours)):
+            dr, dc = neighbours[bit]
+            neighbour = gray[:, r + dr:rows - r + dr, r + dc:columns - r + dc]
+            codes |= (neighbour >= center).astype(np.intp) << bit
+        index = (np.arange(number)[:, np.newaxis, np.newaxis] * 256 + codes)
+        histogram = np.bincount(index.ravel(), minlength=number * 256)
+        return (histogram.reshape([number, 256]) /
+                float(max(1, center.shape[1] * center.shape[2])))
+
+register_extractor('rgb', RGBExtractor)
+register_extractor('hog', HOGExtractor)
+register_extractor('color_hist', ColorHistogramExtractor)
+register_extractor('lbp', LBPExtractor)
+
+def parse_value(value):
+    for value_type in [int, float]:
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
+def parse_feature_set(description):
+    """
+    Returns the extractors of a feature set description, e.g.
+    'rgb:size=25,hog:orientations=9,color_hist'.
+    """
+    extractors = []
+    for item in description.split(','):
+        parts = item.strip().split(':')
+        if parts[0] not in EXTRACTORS:
+            raise ValueError('Unknown feature extractor ' + parts[0])
+        parameters = dict()
+        for part in parts[1:]:
+            key, value = part.split('=')
+            parameters[key.strip()] = parse_value(value.strip())
+        extractors.append(EXTRACTORS[parts[0]](**parameters))
+    return extractors
+
+class FeatureSet(object):
+    """
+    A list of extractors whose outputs are concatenated.
+
+    Parameters
+    ----------
+    description : description of the feature set (see parse_feature_set).
+
+    image_size : size the images are resized to when they are decoded.
+    """
+    def __init__(self, description, image_size):
+        self.extractors = parse_feature_set(description)
+        self.image_size = image_size
+
+    def description(self):
+        return ','.join(extractor.description()
+                        for extractor in self.extractors)
+
+    def widths(self):
+        return [extractor.width(self.image_size)
+                for extractor in self.extractors]
+
+    def width(self):
+        """
+        Returns the number of features of an image.
+        """
+        return sum(self.widths())
+
+    def columns(self, name):
+        """
+        Returns the first and the last (excluded) column of the first
+        extractor called name, or None if there is no such extractor.
+        """
+        start = 0
+        for extractor, width in zip(self.extractors, self.widths()):
+            if extractor.name == name:
+                return start, start + width
+            start += width
+        return None
+
+    def extract(self, files):
+        """
+        Returns the (N, width) features of a list of images (file names or
+        file objects). Every image is decoded once.
+        """
+        with instrumentation.stage('decode'):
+            images = batch_features.decode_images(files, self.image_size)
+            gray = batch_features.rgb_to_gray(images)
+        instrumentation.count('images_decoded', len(files))
+        features = []
+        for extractor in self.extractors:
+            with instrumentation.stage(extractor.name):
+                features.append(extractor.extract(images, gray))
+        return np.hstack(features)
+
+    def iter_extract(self, files, batch_size=batch_features.BATCH_SIZE):
+        """
+        Yields the features of a list of images batch by batch.
+        """
+        for start in range(0, len(files), batch_size):
+            yield self.extract(files[start:start + batch_size])
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that adds an optional stage between the feature extraction
+and the training. It creates a feature configuration: a copy of the train and
+test feature matrices that is either
+
+    - stored compact: the RGB columns as uint8 (or float16) and the HOG columns
+      as float32, or
+    - reduced: projected to fewer dimensions by an IncrementalPCA or a random
+      projection that is fitted on the training matrix. The fitted reducer is
+      saved and applied to the matrices of all the countries.
+
+The matrices of a configuration are saved in REDUCED_MATRICES_PATH/<name>/ with
+the same folders as the original matrices, so classify_countries and
+test_accuracy can use them with the parameter features=<name>.
+
+This program can run indepedently:
+    python feature_reduction.py create --rgb-dtype uint8 --reducer ipca
+    python feature_reduction.py report --classifier 0
+"""
+
+import os
+import time
+import shutil
+import argparse
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+import create_images_feature_matrices as create_matrices
+import feature_store
+
+# folder of the feature configurations
+REDUCED_MATRICES_PATH = 'reduced_matrices/'
+
+# file of the fitted reducer of a configuration
+REDUCER_FILENAME = 'reducer.pkl'
+
+# number of rows processed at once
+CHUNK_SIZE = 1000
+
+# configurations compared by report()
+REPORT_CONFIGURATIONS = [('uint8', None, 0), ('float16', None, 0),
+                         ('uint8', 'ipca', 100), ('uint8', 'random', 500)]
+
+def configuration_name(rgb_dtype='uint8', reducer=None, components=100):
+    """
+    Returns the name of a feature configuration, e.g. 'uint8' or 'uint8_ipca100'.
+    """
+    if reducer is None:
+        return rgb_dtype
+    return '%s_%s%d' % (rgb_dtype, reducer, components)
+
+def matrices_paths(features=None):
+    """
+    Returns the train and the test matrices folders of a feature configuration.
+    With features=None the folders of the original matrices are returned.
+    """
+    if features is None:
+        return (create_matrices.TRAIN_MATRICES_EXPORT_PATH,
+                create_matrices.TEST_MATRICES_EXPORT_PATH)
+    root = os.path.join(REDUCED_MATRICES_PATH, features)
+    return (os.path.join(root, create_matrices.TRAIN_MATRICES_EXPORT_PATH),
+            os.path.join(root, create_matrices.TEST_MATRICES_EXPORT_PATH))
+
+def rgb_columns():
+    """
+    Returns the number of RGB columns at the start of the feature matrices
+    (0 if the feature set does not start with the RGB values).
+    """
+    columns = create_matrices.load_feature_set().columns('rgb')
+    if columns is None or columns[0] != 0:
+        return 0
+    return columns[1]
+
+def as_stored(chunk, rgb_dtype):
+    """
+    Returns a chunk of features with its RGB columns rounded to the way they
+    are stored in rgb_dtype.
+    """
+    chunk = np.array(chunk, dtype=feature_store.FEATURES_DTYPE)
+    chunk[:, :rgb_columns()] = chunk[:, :rgb_columns()].astype(rgb_dtype)
+    return chunk
+
+def compact_matrix(source, destination, rgb_dtype='uint8',
+                   chunk_size=CHUNK_SIZE):
+    """
+    Stores a feature matrix compact: the RGB columns as rgb_dtype in
+    <destination>_rgb and the HOG columns as float32 in <destination>_hog.
+    """
+    X = feature_store.load_matrix(source)
+    rgb = feature_store.create_matrix(destination + '_rgb',
+                                      [X.shape[0], rgb_columns()], rgb_dtype)
+    hog = feature_store.create_matrix(destination + '_hog',
+                        [X.shape[0], X.shape[1] - rgb_columns()])
+    start = 0
+    for chunk in feature_store.iter_matrix_chunks(source, chunk_size):
+        rgb[start:start + len(chunk)] = chunk[:, :rgb_columns()]
+        hog[start:start + len(chunk)] = chunk[:, rgb_columns():]
+        start += len(chunk)
+    rgb.flush()
+    hog.flush()
+    del rgb, hog
+
+def fit_reducer(source, reducer, components, rgb_dtype='uint8',
+                chunk_size=CHUNK_SIZE):
+    """
+    Fits a reducer on a feature matrix, chunk by chunk.
+
+    Parameters
+    ----------
+    source : name of the training feature matrix.
+
+    reducer : 'ipca' for IncrementalPCA or 'random' for a sparse random
+            projection.
+
+    components : number of dimensions after the reduction.
+
+    rgb_dtype : data type the RGB columns are stored as before the reduction.
+    """
+    X = feature_store.load_matrix(source)
+    rows = X.shape[0]
+    if reducer == 'ipca':
+        # every partial fit needs at least as many rows as components
+        chunks_number = max(1, rows // max(chunk_size, components))
+        components = min(components, rows // chunks_number, X.shape[1])
+        model = IncrementalPCA(n_components=components)
+        bounds = np.linspace(0, rows, chunks_number + 1).astype(int)
+        for i in range(chunks_number):
+            model.partial_fit(as_stored(X[bounds[i]:bounds[i + 1]],
+                                        rgb_dtype))
+    elif reducer == 'random':
+        # the projection only depends on the number of columns
+        model = SparseRandomProjection(n_components=components,
+                                       random_state=42)
+        model.fit(as_stored(X[:1], rgb_dtype))
+    else:
+        raise ValueError('Unknown reducer ' + str(reducer))
+    return model
+
+def reduce_matrix(model, source, destination, rgb_dtype='uint8',
+                  chunk_size=CHUNK_SIZE):
+    """
+    Applies a fitted reducer to a feature matrix chunk by chunk and saves the
+    reduced float32 matrix.
+    """
+    rows = feature_store.load_matrix(source).shape[0]
+    reduced = None
+    start = 0
+    for chunk in feature_store.iter_matrix_chunks(source, chunk_size):
+        chunk = model.transform(as_stored(chunk, rgb_dtype))
+        if reduced is None:
+            reduced = feature_store.create_matrix(destination,
+                                                  [rows, chunk.shape[1]])
+        reduced[start:start + len(chunk)] = chunk
+        start += len(chunk)
+    if reduced is not None:
+        reduced.flush()
+    del reduced
+
+def create_configuration(rgb_dtype='uint8', reducer=None, components=100,
+                         chunk_size=CHUNK_SIZE):
+    """
+    Creates the train and test matrices of a feature configuration and returns
+    its name and the time (in seconds) it took.
+
+    Parameters
+    ----------
+    rgb_dtype : data type of the RGB columns ('uint8' or 'float16').
+
+    reducer : None to only store the matrices compact, 'ipca' or 'random' to
+            reduce their dimensions.
+
+    components : number of dimensions after the reduction. IncrementalPCA
+            may fit fewer (see fit_reducer), the configuration is named after
+            the number of dimensions that was fitted.
+    """
+    start = time.time()
+    sources = [create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X']
+    sources.extend(feature_store.list_matrices(
+                        create_matrices.TEST_MATRICES_EXPORT_PATH + 'test_X_*'))
+    model = None
+    if reducer is not None:
+        model = fit_reducer(sources[0], reducer, components, rgb_dtype,
+                            chunk_size)
+        components = model.n_components_
+    features = configuration_name(rgb_dtype, reducer, components)
+    train_path, test_path = matrices_paths(features)
+    for path in [train_path, test_path]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+    # the labels and the classes do not change
+    feature_store.save_matrix(train_path + 'train_y', feature_store.load_matrix(
+        create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'),
+        feature_store.LABELS_DTYPE)
+    shutil.copy(create_matrices.TRAIN_MATRICES_EXPORT_PATH +
+                'class_themes.txt', train_path)
+
+    destinations = [train_path + 'train_X']
+    destinations.extend([test_path + os.path.basename(source)
+                         for source in sources[1:]])
+
+    if model is None:
+        for source, destination in zip(sources, destinations):
+            compact_matrix(source, destination, rgb_dtype, chunk_size)
+    else:
+        joblib.dump(model, os.path.join(REDUCED_MATRICES_PATH, features,
+                                        REDUCER_FILENAME))
+        for source, destination in zip(sources, destinations):
+            reduce_matrix(model, source, destination, rgb_dtype, chunk_size)
+    return features, time.time() - start
+
+def matrix_size(name):
+    """
+    Returns the size (in megabytes) of the files of a matrix.
+    """
+    return sum(os.path.getsize(path) for path in
+               feature_store.matrix_files(name)) / (1024. * 1024.)
+
+def report(classifier=0, configurations=REPORT_CONFIGURATIONS):
+    """
+    Creates every feature configuration and prints for each one the disk size
+    of the training matrix, its size in memory when a classifier is fitted on 
+    it (load_matrix converts compact matrices back to float32), the time to 
+    create the configuration, the fit and predict times of a new classifier 
+    on the split of test_accuracy and its accuracy. The original matrices are 
+    the first line.
+    """
+    # imported here because it loads scikit-learn models
+    import model_registry
+    try:
+        from sklearn.model_selection import train_test_split
+    except ImportError:
+        from sklearn.cross_validation import train_test_split
+
+    results = []
+    names = [(None, 0.)]
+    for rgb_dtype, reducer, components in configurations:
+        names.append(create_configuration(rgb_dtype, reducer, components))
+
+    for features, create_time in names:
+        train_path = matrices_paths(features)[0]
+        train_X = feature_store.load_matrix(train_path + 'train_X')
+        train_y = feature_store.load_matrix(train_path + 'train_y')
+        X_train, X_test, y_train, y_test = train_test_split( \
+        train_X, train_y, test_size=0.3, random_state=42)
+        
+        # a new classifier is always fitted, the saved models of 
+        # model_registry would only be loaded
+        clf = model_registry.create_classifier(classifier)
+        start = time.time()
+        clf.fit(X_train, y_train)
+        fit_time = time.time() - start
+        start = time.time()
+        y_predict = clf.predict(X_test)
+        predict_time = time.time() - start
+        results.append({'features' : features or 'original',
+                        'columns' : train_X.shape[1],
+                        'disk_MB' : matrix_size(train_path + 'train_X'),
+                        'memory_MB' : train_X.nbytes / (1024. * 1024.),
+                        'create_s' : create_time,
+                        'fit_s' : fit_time,
+                        'predict_s' : predict_time,
+                        'accuracy' : np.mean(y_predict == y_test) * 100.})
+
+    print('%-18s %8s %10s %12s %10s %8s %11s %9s' % ('features', 'columns',
+            'disk (MB)', 'memory (MB)', 'create (s)', 'fit (s)', 
+            'predict (s)', 'accuracy'))
+    for result in results:
+        print('%-18s %8d %10.1f %12.1f %10.2f %8.2f %11.2f %8.1f%%' % (
+                result['features'], result['columns'], result['disk_MB'],
+                result['memory_MB'], result['create_s'], result['fit_s'],
+                result['predict_s'], result['accuracy']))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact and reduced '
+                                     'feature matrices.')
+    subparsers = parser.add_subparsers(dest='command')
+    create_parser = subparsers.add_parser('create',
+                    help='create the matrices of a feature configuration')
+    create_parser.add_argument('--rgb-dtype', default='uint8',
+                               choices=['uint8', 'float16'])
+    create_parser.add_argument('--reducer', choices=['ipca', 'random'])
+    create_parser.add_argument('--components', type=int, default=100)
+    report_parser = subparsers.add_parser('report',
+                    help='compare the accuracy of feature configurations')
+    report_parser.add_argument('--classifier', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        features, create_time = create_configuration(args.rgb_dtype,
+                                                args.reducer, args.components)
+        print('Created features %s in %.2f s' % (features, create_time))
+    elif args.command == 'report':
+        report(args.classifier)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper script that stores the feature matrices in a binary format
+instead of text files. Every matrix is saved as a .npy file, which is a small
+header (data type and shape) followed by the raw array data. The matrices are
+opened with np.memmap, so loading them does not parse or copy anything.
+
+Features are stored as float32 and class labels as uint8. A feature matrix
+can also be stored compact in two parts, <name>_rgb with the RGB columns (e.g.
+uint8) and <name>_hog with the HOG columns (see feature_reduction.py).
+
+It also contains a converter for feature matrices that were exported as .txt
+files by older versions of the code and a benchmark that compares the binary
+format with np.savetxt/np.loadtxt.
+This program can run indepedently:
+    python feature_store.py convert train_data_matrices/ test_data_matrices/
+    python feature_store.py benchmark --rows 1000
+"""
+
+import os
+import glob
+import time
+import struct
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+# file extensions of the binary and the (old) text matrices
+MATRIX_EXTENSION = '.npy'
+TEXT_EXTENSION = '.txt'
+
+# data types of the stored matrices
+FEATURES_DTYPE = np.float32
+LABELS_DTYPE = np.uint8
+
+# suffixes of the two parts of a compact matrix (RGB and HOG columns)
+COMPACT_PARTS = ['_rgb', '_hog']
+
+# size (in bytes) of the header of a matrix written by MatrixWriter. It is
+# large enough for any shape, so the header can be rewritten in place.
+APPEND_HEADER_SIZE = 128
+
+def matrix_name(path):
+    """
+    Returns the name of a matrix (its path without the file extension).
+    """
+    for extension in [MATRIX_EXTENSION, TEXT_EXTENSION]:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+def matrix_path(name):
+    """
+    Returns the path of the binary file of a matrix.
+    """
+    return matrix_name(name) + MATRIX_EXTENSION
+
+def create_matrix(name, shape, dtype=FEATURES_DTYPE):
+    """
+    Creates a new binary matrix of zeros on disk and returns it opened as a
+    writable memory map. Rows can be filled in one by one and they are written
+    to disk when the returned array is flushed or deleted.
+
+    Parameters
+    ----------
+    name : path of the matrix with or without the file extension.
+
+    shape : shape of the matrix.
+
+    dtype : data type of the matrix.
+    """
+    return np.lib.format.open_memmap(matrix_path(name), mode='w+',
+                                     dtype=dtype, shape=tuple(shape))
+
+def open_matrix(name):
+    """
+    Opens an existing binary matrix as a writable memory map, e.g. to fill in
+    some of its rows from another process.
+    """
+    return np.load(matrix_path(name), mmap_mode='r+')
+
+def save_matrix(name, array, dtype=FEATURES_DTYPE):
+    """
+    Saves an array to a binary matrix file.
+
+    Parameters
+    ----------
+    name : path of the matrix with or without the file extension.
+
+    array : the array to be saved.
+
+    dtype : data type that the array will be stored as.
+    """
+    array = np.asarray(array)
+    matrix = create_matrix(name, array.shape, dtype)
+    matrix[...] = array
+    matrix.flush()
+    del matrix
+
+def write_header(matrix_file, shape, dtype, size=APPEND_HEADER_SIZE):
+    """
+    Writes a .npy (version 1.0) header padded to a fixed size.
+    """
+    header = repr({'descr' : np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   'fortran_order' : False, 'shape' : tuple(shape)})
+    # magic string (6 bytes), version (2 bytes) and header length (2 bytes)
+    header = header.ljust(size - 10 - 1) + '\n'
+    matrix_file.write(np.lib.format.magic(1, 0) +
+                      struct.pack('<H', len(header)) + header.encode('latin1'))
+
+class MatrixWriter(object):
+    """
+    Writes a binary matrix by appending rows, without knowing the number of
+    rows in advance. The header is written with 0 rows first and rewritten
+    with the final number of rows by close(), so an interrupted write leaves
+    an empty but valid matrix.
+
+    Parameters
+    ----------
+    name : path of the matrix with or without the file extension.
+
+    columns : number of columns, None for a vector (e.g. labels).
+
+    dtype : data type of the matrix.
+
+    append : if True and the matrix exists, the rows are appended to its
+            rows instead of replacing them. A matrix that is only stored as
+            a .txt file or in compact parts cannot be appended to.
+    """
+    def __init__(self, name, columns=None, dtype=FEATURES_DTYPE,
+                 append=False):
+        self.path = matrix_path(name)
+        if append and not os.path.exists(self.path) and (is_compact(name) or
+                os.path.exists(matrix_name(name) + TEXT_EXTENSION)):
+            # load_matrix would only read the new binary file with the
+            # appended rows and ignore the existing ones
+            raise ValueError('Cannot append rows to %s, it is not a binary '
+                             'matrix (see convert_txt_matrix)' %
+                             matrix_name(name))
+        self.columns = columns
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.header_size = APPEND_HEADER_SIZE
+        if append and os.path.exists(self.path):
+            self.matrix_file = open(self.path, 'r+b')
+            version = np.lib.format.read_magic(self.matrix_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                        np.lib.format.read_array_header_1_0(self.matrix_file)
+            else:
+                self.matrix_file.close()
+                raise ValueError(self.path + ' has an unsupported header')
+            if (fortran_order or np.dtype(dtype) != self.dtype or
+                    tuple(shape[1:]) != self.shape()[1:]):
+                self.matrix_file.close()
+                raise ValueError('Cannot append rows of shape %s and type %s'
+                                 ' to %s' % (self.shape()[1:], self.dtype,
+                                             self.path))
+            # the header is rewritten in place with its original size
+            self.header_size = self.matrix_file.tell()
+            self.rows = shape[0]
+            self.matrix_file.seek(0, os.SEEK_END)
+        else:
+            self.matrix_file = open(self.path, 'wb')
+            write_header(self.matrix_file, self.shape(), self.dtype)
+            self.matrix_file.flush()
+
+    def shape(self):
+        if self.columns is None:
+            return (self.rows,)
+        return (self.rows, self.columns)
+
+    def append(self, rows):
+        """
+        Appends rows (an array of shape (n, columns), or (n,) for a vector).
+        """
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.shape()[1:]:
+            raise ValueError('Expected rows of shape %s, got %s' %
+                             (self.shape()[1:], rows.shape[1:]))
+        self.matrix_file.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def close(self):
+        if self.matrix_file is None:
+            return
+        self.matrix_file.seek(0)
+        write_header(self.matrix_file, self.shape(), self.dtype,
+                     self.header_size)
+        self.matrix_file.close()
+        self.matrix_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+def is_compact(name):
+    """
+    Returns True if a matrix is stored compact in an RGB and a HOG part.
+    """
+    name = matrix_name(name)
+    return all(os.path.exists(name + part + MATRIX_EXTENSION)
+               for part in COMPACT_PARTS)
+
+def matrix_files(name):
+    """
+    Returns the paths of the files of a matrix: the binary file if it exists, 
+    otherwise the files of the compact parts or the .txt file.
+    """
+    name = matrix_name(name)
+    if os.path.exists(name + MATRIX_EXTENSION):
+        return [name + MATRIX_EXTENSION]
+    if is_compact(name):
+        return [name + part + MATRIX_EXTENSION for part in COMPACT_PARTS]
+    if os.path.exists(name + TEXT_EXTENSION):
+        return [name + TEXT_EXTENSION]
+    raise IOError('No matrix found for ' + name)
+
+def load_matrix(name, mmap=True):
+    """
+    Loads a matrix. The binary file is used if it exists, otherwise the 
+    compact parts are joined to one FEATURES_DTYPE matrix or the .txt file of
+    the matrix is parsed with np.loadtxt.
+
+    Parameters
+    ----------
+    name : path of the matrix with or without the file extension.
+
+    mmap : if True the binary matrix is opened read-only as a memory map
+        (zero-copy), otherwise it is read into memory.
+    """
+    name = matrix_name(name)
+    if os.path.exists(name + MATRIX_EXTENSION):
+        return np.load(name + MATRIX_EXTENSION,
+                       mmap_mode='r' if mmap else None)
+    if is_compact(name):
+        return np.hstack([load_matrix(name + part).astype(FEATURES_DTYPE)
+                          for part in COMPACT_PARTS])
+    if os.path.exists(name + TEXT_EXTENSION):
+        return np.loadtxt(name + TEXT_EXTENSION)
+    raise IOError('No matrix found for ' + name)
+
+def iter_matrix_chunks(name, chunk_size):
+    """
+    Reads a matrix in chunks of at most chunk_size rows and yields every chunk 
+    as an in-memory array. The file is read sequentially, so only one chunk is 
+    in memory at a time no matter how large the matrix is.
+
+    Parameters
+    ----------
+    name : path of the matrix with or without the file extension.
+
+    chunk_size : maximum number of rows of a chunk.
+    """
+    name = matrix_name(name)
+    if os.path.exists(name + MATRIX_EXTENSION):
+        with open(name + MATRIX_EXTENSION, 'rb') as matrix_file:
+            version = np.lib.format.read_magic(matrix_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = \
+                            np.lib.format.read_array_header_1_0(matrix_file)
+            else:
+                shape, fortran_order, dtype = \
+                            np.lib.format.read_array_header_2_0(matrix_file)
+            if fortran_order:
+                raise ValueError(name + ' is not stored in row order')
+            row_size = int(np.prod(shape[1:]))
+            for start in range(0, shape[0], chunk_size):
+                rows = min(chunk_size, shape[0] - start)
+                chunk = np.fromfile(matrix_file, dtype=dtype, 
+                                    count=rows * row_size)
+                yield chunk.reshape((rows,) + tuple(shape[1:]))
+    elif is_compact(name):
+        parts = [iter_matrix_chunks(name + part, chunk_size)
+                 for part in COMPACT_PARTS]
+        for chunks in zip(*parts):
+            yield np.hstack([chunk.astype(FEATURES_DTYPE) 
+                             for chunk in chunks])
+    elif os.path.exists(name + TEXT_EXTENSION):
+        with open(name + TEXT_EXTENSION) as txt_file:
+            lines = []
+            for line in txt_file:
+                if not line.strip():
+                    continue
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    yield np.loadtxt(lines, ndmin=2)
+                    lines = []
+            if lines:
+                yield np.loadtxt(lines, ndmin=2)
+    else:
+        raise IOError('No matrix found for ' + name)
+
+def list_matrices(pattern):
+    """
+    Returns the sorted names of all matrices (binary, compact or text) that 
+    match a glob pattern given without a file extension. Example: 
+    'test_data_matrices/*'.
+    """
+    names = set()
+    for extension in [MATRIX_EXTENSION, TEXT_EXTENSION]:
+        for path in glob.glob(pattern + extension):
+            name = matrix_name(path)
+            for part in COMPACT_PARTS:
+                if name.endswith(part) and is_compact(name[:-len(part)]):
+                    name = name[:-len(part)]
+            names.add(name)
+    return sorted(names)
+
+def convert_txt_matrix(txt_path, dtype=FEATURES_DTYPE):
+    """
+    Converts a matrix saved with np.savetxt to the binary format. The text file
+    is read line by line, so the whole matrix never has to fit in memory.
+
+    Parameters
+    ----------
+    txt_path : path of the .txt matrix.
+
+    dtype : data type that the matrix will be stored as.
+    """
+    # first pass: find the shape of the matrix
+    rows = 0
+    columns = None
+    with open(txt_path) as txt_file:
+        for line in txt_file:
+            if not line.strip():
+                continue
+            if columns is None:
+                columns = len(line.split())
+            rows += 1
+
+    # np.loadtxt returns a 1-D array for a single column (e.g. train_y.txt)
+    if columns == 1:
+        shape = [rows]
+    else:
+        shape = [rows, columns or 0]
+    matrix = create_matrix(txt_path, shape, dtype)
+
+    # second pass: parse every row straight into the memory map
+    counter = 0
+    try:
+        with open(txt_path) as txt_file:
+            for line in txt_file:
+                if not line.strip():
+                    continue
+                values = np.array(line.split(), dtype=np.float64)
+                matrix[counter] = values[0] if columns == 1 else values
+                counter += 1
+        matrix.flush()
+    except ValueError:
+        # do not leave a half written matrix behind
+        del matrix
+        os.remove(matrix_path(txt_path))
+        raise
+    del matrix
+    return matrix_path(txt_path)
+
+def convert_folder(folder):
+    """
+    Converts all the train and test .txt matrices of a folder to the binary
+    format. Label matrices (names ending in '_y') are stored as LABELS_DTYPE
+    and feature matrices as FEATURES_DTYPE.
+    """
+    converted = []
+    for txt_path in sorted(glob.glob(os.path.join(folder, '*' +
+                                                  TEXT_EXTENSION))):
+        name = os.path.basename(matrix_name(txt_path))
+        if name.endswith('_y'):
+            dtype = LABELS_DTYPE
+        elif '_X' in name:
+            dtype = FEATURES_DTYPE
+        else:
+            # not a matrix, e.g. class_themes.txt
+            continue
+        try:
+            converted.append(convert_txt_matrix(txt_path, dtype))
+        except ValueError:
+            print('Skipping ' + txt_path + ': not a numeric matrix')
+    return converted
+
+def file_size(path):
+    """
+    Returns the size of a file in megabytes.
+    """
+    return os.path.getsize(path) / (1024. * 1024.)
+
+def benchmark(rows=1000, columns=7788, repeat=3):
+    """
+    Compares write time, load time and disk size of the text matrices
+    (np.savetxt/np.loadtxt) with the binary matrices of this module, using a
+    random matrix that looks like the RGB + HOG features.
+
+    Parameters
+    ----------
+    rows : number of rows (images) of the matrix.
+
+    columns : number of columns (features) of the matrix.
+
+    repeat : number of times every measurement is repeated. The best time is
+        reported.
+    """
+    # RGB values are integers in [0, 255], HOG values are floats in [0, 1]
+    hog_size = min(288, columns)
+    features = np.empty([rows, columns])
+    features[:, :columns - hog_size] = np.random.randint(256,
+                                            size=[rows, columns - hog_size])
+    features[:, columns - hog_size:] = np.random.rand(rows, hog_size)
+
+    folder = tempfile.mkdtemp()
+    name = os.path.join(folder, 'bench_X')
+
+    def best_time(function):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+        return min(times)
+
+    def read_all(matrix):
+        # touch every value so that lazy loading is also measured
+        return float(np.asarray(matrix).sum())
+
+    try:
+        results = dict()
+        results['text'] = {
+            'write': best_time(lambda: np.savetxt(name + TEXT_EXTENSION,
+                                                  features)),
+            'open': best_time(lambda: np.loadtxt(name + TEXT_EXTENSION)),
+            'size': file_size(name + TEXT_EXTENSION)}
+        results['text']['read'] = results['text']['open']
+
+        results['binary'] = {
+            'write': best_time(lambda: save_matrix(name, features)),
+            'open': best_time(lambda: load_matrix(name)),
+            'read': best_time(lambda: read_all(load_matrix(name))),
+            'size': file_size(name + MATRIX_EXTENSION)}
+    finally:
+        shutil.rmtree(folder)
+
+    print('Matrix of %d x %d features' % (rows, columns))
+    print('%-8s %10s %10s %10s %10s' % ('format', 'write (s)', 'open (s)',
+                                        'read (s)', 'size (MB)'))
+    for store in ['text', 'binary']:
+        print('%-8s %10.3f %10.3f %10.3f %10.2f' % (store,
+                results[store]['write'], results[store]['open'],
+                results[store]['read'], results[store]['size']))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Binary feature matrices.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser('convert',
+                    help='convert the .txt matrices of folders to binary')
+    convert_parser.add_argument('folders', nargs='*', default=[
+                    'train_data_matrices/', 'test_data_matrices/'])
+
+    benchmark_parser = subparsers.add_parser('benchmark',
+                    help='compare the text and the binary matrices')
+    benchmark_parser.add_argument('--rows', type=int, default=1000)
+    benchmark_parser.add_argument('--columns', type=int, default=7788)
+    benchmark_parser.add_argument('--repeat', type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        for folder in args.folders:
+            for path in convert_folder(folder):
+                print('Created ' + path)
+    elif args.command == 'benchmark':
+        benchmark(args.rows, args.columns, args.repeat)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
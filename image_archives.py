@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper program that reads the train and test images from packed
+archives (tar or zip shards) instead of opening every small image file on its
+own. On network filesystems the open and stat calls of tens of thousands of
+files cost more than reading their bytes, while a shard is read sequentially
+with large buffered reads.
+
+The label of an image is the folder that contains it in the archive, exactly
+like the folders of the train and test data:
+
+    beach/img1.jpg           a train image of theme beach
+    visit_austria/p1.jpg     a test image of country austria
+
+Shards are read in the order of their names and the images of a shard in the
+order they are stored. The streaming pipeline of streaming_ingest.py reads the
+archives of create_images_feature_matrices.TRAIN_ARCHIVES_PATH and
+TEST_ARCHIVES_PATH with "--archives".
+
+This program can run indepedently to pack existing folders into shards:
+    python image_archives.py pack train_data train_data_shards
+    python image_archives.py pack test_data test_data_shards --format zip
+    python image_archives.py list train_data_shards/*
+"""
+
+import os
+import glob
+import zipfile
+import tarfile
+import argparse
+import instrumentation
+
+# size of the read buffer of the tar shards
+READ_BUFFER = 4 * 1024 * 1024
+
+# number of images of a shard created by pack
+SHARD_IMAGES = 1000
+
+# archive formats of pack
+FORMATS = ['tar', 'zip']
+
+def is_zip(path):
+    return path.lower().endswith('.zip')
+
+def iter_archive(path):
+    """
+    Yields the name and the bytes of every file of a tar (also compressed)
+    or zip archive, in the order they are stored.
+    """
+    if is_zip(path):
+        with zipfile.ZipFile(path) as archive:
+            members = sorted([info for info in archive.infolist()
+                              if not info.filename.endswith('/')],
+                             key=lambda info: info.header_offset)
+            for info in members:
+                yield info.filename, archive.read(info)
+    else:
+        with open(path, 'rb', READ_BUFFER) as archive_file:
+            # stream mode: the archive is read once from start to end
+            archive = tarfile.open(fileobj=archive_file, mode='r|*')
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read()
+            archive.close()
+
+def member_folder(name):
+    """
+    Returns the folder that contains an archive member (its label), or None
+    for a member at the top of the archive.
+    """
+    parts = name.replace('\\', '/').strip('/').split('/')
+    if len(parts) < 2:
+        return None
+    return parts[-2]
+
+def iter_images(pattern):
+    """
+    Yields a tuple (folder, member name, bytes) for every image of the
+    archives that match a glob pattern.
+    """
+    for path in sorted(glob.glob(pattern)):
+        with instrumentation.stage('read_archive'):
+            for name, data in iter_archive(path):
+                folder = member_folder(name)
+                if folder is not None:
+                    yield folder, name, data
+        instrumentation.count('archives_read')
+
+def pack(folder, output_folder, shard_images=SHARD_IMAGES,
+         archive_format='tar'):
+    """
+    Packs the images of the sub folders of a folder (themes or visit_<country>
+    folders) into shards of shard_images images. The images of a sub folder
+    are stored next to each other. Returns the list of the created shards.
+
+    Parameters
+    ----------
+    folder : folder of the images, e.g. train_data.
+
+    output_folder : folder of the shards, e.g. train_data_shards.
+
+    shard_images : number of images of a shard.
+
+    archive_format : 'tar' or 'zip'. The images are already compressed, so
+            the archives are not.
+    """
+    if archive_format not in FORMATS:
+        raise ValueError('Unknown archive format ' + str(archive_format))
+    files = sorted(file_ for file_ in glob.glob(os.path.join(folder, '*', '*'))
+                   if os.path.isfile(file_))
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    shards = []
+    for start in range(0, len(files), shard_images):
+        path = os.path.join(output_folder, 'shard-%05d.%s' % (len(shards),
+                                                              archive_format))
+        if archive_format == 'zip':
+            archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+            add = archive.write
+        else:
+            archive = tarfile.open(path, 'w')
+            add = archive.add
+        try:
+            for file_ in files[start:start + shard_images]:
+                # members are named <sub folder>/<file name>
+                add(file_, os.path.relpath(file_, folder).replace(os.sep, '/'))
+        finally:
+            archive.close()
+        shards.append(path)
+    return shards
+
+def main():
+    parser = argparse.ArgumentParser(description='Packs image folders into '
+                                     'tar or zip shards.')
+    subparsers = parser.add_subparsers(dest='command')
+    pack_parser = subparsers.add_parser('pack', help='pack the sub folders '
+                                        'of a folder into shards')
+    pack_parser.add_argument('folder')
+    pack_parser.add_argument('output_folder')
+    pack_parser.add_argument('--shard-images', type=int, default=SHARD_IMAGES)
+    pack_parser.add_argument('--format', default='tar', choices=FORMATS)
+    list_parser = subparsers.add_parser('list', help='count the images of '
+                                        'every folder of some shards')
+    list_parser.add_argument('archives', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        shards = pack(args.folder, args.output_folder, args.shard_images,
+                      args.format)
+        print('Created %d shards in %s' % (len(shards), args.output_folder))
+    elif args.command == 'list':
+        counts = dict()
+        for path in args.archives:
+            for name, data in iter_archive(path):
+                folder = member_folder(name)
+                counts[folder] = counts.get(folder, 0) + 1
+        for folder in sorted(counts, key=str):
+            print('%-30s %d' % (folder, counts[folder]))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
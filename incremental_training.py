@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that trains a classifier out of core: the training matrix
+is read from the feature store in chunks of CHUNK_SIZE rows, so the memory used
+does not depend on the number of training images.
+
+Modes:
+    random_forest, extra_trees : the forest grows by TREES_PER_CHUNK trees
+            (warm_start) that are trained on every chunk. The chunks are
+            stratified, so every chunk contains every theme.
+    sgd : a linear model with logistic loss trained with partial_fit, after
+            a StandardScaler that is fitted with partial_fit as well.
+
+The trained model and the number of rows it was trained on are saved in the
+models folder (see model_registry.py), with a fingerprint of these rows. New
+labeled images can be appended to the training matrix and the saved model is
+then only trained on the new rows (the forests also replay a sample of the old
+rows), not from zero. If the rows it was trained on changed (e.g. the matrices
+were created again) the model is trained from zero. Appended images are also
+copied to the folder of their theme, so they are kept by the next extraction.
+
+This program can run indepedently:
+    python incremental_training.py train --mode sgd
+    python incremental_training.py append --theme beach new_images/*.jpg
+    python incremental_training.py accuracy --mode random_forest
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import sklearn
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
+import create_images_feature_matrices as create_matrices
+import classify_countries
+import feature_store
+import model_registry
+import instrumentation
+from feature_cache import FeatureCache
+
+# training modes
+MODES = ['random_forest', 'extra_trees', 'sgd']
+
+# number of rows read and trained at once
+CHUNK_SIZE = 1000
+
+# number of trees added to a forest for every chunk
+TREES_PER_CHUNK = 10
+
+# number of passes of the sgd mode over the rows
+SGD_EPOCHS = 5
+
+def sgd_loss():
+    # the logistic loss was renamed in scikit-learn 1.1
+    version = tuple(int(part) for part in sklearn.__version__.split('.')[:2])
+    if version >= (1, 1):
+        return 'log_loss'
+    return 'log'
+
+def create_model(mode):
+    """
+    Creates an untrained model of a training mode.
+    """
+    if mode == 'random_forest':
+        return RandomForestClassifier(n_estimators=0, warm_start=True)
+    elif mode == 'extra_trees':
+        return ExtraTreesClassifier(n_estimators=0, warm_start=True)
+    elif mode == 'sgd':
+        return Pipeline([('scaler', StandardScaler()),
+                         ('sgd', SGDClassifier(loss=sgd_loss(),
+                                               random_state=42))])
+    raise ValueError('Unknown training mode ' + str(mode))
+
+def row_chunks(y, rows, chunk_size=CHUNK_SIZE, random_state=42):
+    """
+    Splits rows of the training matrix in chunks of about chunk_size sorted
+    rows. The rows of every theme are shuffled and dealt to the chunks in
+    turn, so every chunk contains every theme that has at least as many rows
+    as there are chunks.
+    """
+    random = np.random.RandomState(random_state)
+    rows = np.asarray(rows)
+    labels = np.asarray(y[rows])
+    chunks_number = max(1, int(np.ceil(len(rows) / float(chunk_size))))
+    # never more chunks than rows of the smallest theme
+    chunks_number = min(chunks_number, np.bincount(labels)[np.unique(
+                                                            labels)].min())
+    chunk_of_row = np.empty(len(rows), dtype=int)
+    offset = 0
+    for label in np.unique(labels):
+        label_rows = random.permutation(np.flatnonzero(labels == label))
+        chunk_of_row[label_rows] = ((np.arange(len(label_rows)) + offset) %
+                                    chunks_number)
+        offset += len(label_rows)
+    # sorted rows are read from the memory map in one sequential pass
+    return [np.sort(rows[chunk_of_row == i]) for i in range(chunks_number)]
+
+def train_rows(clf, mode, X, y, rows, classes, chunk_size=CHUNK_SIZE):
+    """
+    Trains a model on some rows of the training matrix, chunk by chunk, and
+    returns it.
+
+    Parameters
+    ----------
+    clf : model of the mode, new or already trained.
+
+    mode : training mode.
+
+    X, y : training matrix and labels (memory maps).
+
+    rows : rows of X to train on.
+
+    classes : all the labels.
+
+    chunk_size : number of rows read at once.
+    """
+    chunks = row_chunks(y, rows, chunk_size)
+    if mode == 'sgd':
+        scaler = clf.named_steps['scaler']
+        sgd = clf.named_steps['sgd']
+        with instrumentation.stage('scale'):
+            for chunk in chunks:
+                scaler.partial_fit(X[chunk])
+        random = np.random.RandomState(42)
+        with instrumentation.stage('fit'):
+            for epoch in range(SGD_EPOCHS):
+                for i in random.permutation(len(chunks)):
+                    sgd.partial_fit(scaler.transform(X[chunks[i]]),
+                                    y[chunks[i]], classes=classes)
+        return clf
+
+    with instrumentation.stage('fit'):
+        for chunk in chunks:
+            if len(np.unique(y[chunk])) != len(classes):
+                raise ValueError('Every chunk must contain every theme, use '
+                                 'a larger chunk size')
+            clf.n_estimators += TREES_PER_CHUNK
+            clf.fit(X[chunk], y[chunk])
+    return clf
+
+def model_key(mode):
+    return 'incremental_' + mode
+
+def rows_fingerprint(X, y, rows, chunk_size=CHUNK_SIZE):
+    """
+    Returns a hash of the number of columns and of the first rows of the
+    training matrix and labels, read chunk by chunk.
+    """
+    sha = hashlib.sha1(('%d|%d' % (rows, X.shape[1])).encode('ascii'))
+    for start in range(0, rows, chunk_size):
+        end = min(rows, start + chunk_size)
+        sha.update(np.ascontiguousarray(X[start:end]))
+        sha.update(np.ascontiguousarray(y[start:end]))
+    return sha.hexdigest()
+
+def train(mode='sgd', chunk_size=CHUNK_SIZE, from_scratch=False):
+    """
+    Trains the saved model of a mode on the training matrix and saves it. If
+    a saved model exists it is only trained on the rows that were appended
+    since it was saved. Returns the model.
+
+    Parameters
+    ----------
+    mode : training mode ('random_forest', 'extra_trees' or 'sgd').
+
+    chunk_size : number of rows read at once.
+
+    from_scratch : if True the saved model is ignored and a new one is
+            trained on all the rows. This is also done if the rows the saved
+            model was trained on are not the same any more.
+    """
+    X_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X'
+    y_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'
+    X = feature_store.load_matrix(X_name)
+    y = feature_store.load_matrix(y_name)
+    classes = np.arange(len(classify_countries.load_labels()))
+
+    key = model_key(mode)
+    trained_rows = 0
+    clf = None
+    if not from_scratch:
+        info = dict((model['key'], model)
+                    for model in model_registry.list_models()).get(key)
+        # the saved model is only updated if its rows did not change
+        if (info is not None and info.get('mode') == mode and
+                info['rows'] <= len(y) and
+                info.get('features') == X.shape[1] and
+                info.get('fingerprint') == rows_fingerprint(X, y, info['rows'],
+                                                            chunk_size)):
+            clf = model_registry.load_model(key)
+            trained_rows = info['rows']
+    if clf is None:
+        clf = create_model(mode)
+    if trained_rows == len(y):
+        return clf
+
+    rows = np.arange(trained_rows, len(y))
+    if trained_rows and mode != 'sgd':
+        # replay a sample of the old rows, so that every chunk of the new
+        # trees contains every theme
+        random = np.random.RandomState(trained_rows)
+        replay = random.choice(trained_rows, min(trained_rows, max(len(rows),
+                                                 chunk_size)), replace=False)
+        rows = np.concatenate([replay, rows])
+
+    start = time.time()
+    clf = train_rows(clf, mode, X, y, rows, classes, chunk_size)
+    model_registry.save_model(key, clf, {'key' : key, 'classifier' : mode,
+            'estimator' : type(clf).__name__, 'mode' : mode, 'rows' : len(y),
+            'features' : X.shape[1],
+            'fingerprint' : rows_fingerprint(X, y, len(y), chunk_size),
+            'matrices' : [X_name, y_name], 'fit_time' : time.time() - start,
+            'created' : time.ctime()})
+    return clf
+
+def copy_to_theme_folder(files, theme):
+    """
+    Copies images to the folder of their theme in the train data, so that
+    they are kept when the matrices are created again. An image that is
+    already in the folder is not copied and an other image of the same name
+    is never replaced.
+    """
+    folder = os.path.join(os.path.dirname(create_matrices.TRAIN_DATA_PATH),
+                          theme)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for file_ in files:
+        base, extension = os.path.splitext(os.path.basename(file_))
+        copy = os.path.join(folder, base + extension)
+        counter = 0
+        while os.path.exists(copy):
+            if os.path.samefile(copy, file_):
+                break
+            counter += 1
+            copy = os.path.join(folder, '%s_%d%s' % (base, counter, extension))
+        else:
+            shutil.copy2(file_, copy)
+
+def append_images(files, theme):
+    """
+    Appends the features and the label of new images of a theme to the
+    training matrices. Returns the number of appended images.
+
+    The images are also copied to the folder of the theme and their features
+    are saved to the feature cache, so creating the matrices again keeps them
+    without decoding them again. The rows are then in a new order, so the
+    saved models are trained from zero once more.
+    """
+    labels_list = classify_countries.load_labels()
+    if theme not in labels_list:
+        raise ValueError('Unknown theme ' + theme)
+    X_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X'
+    y_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'
+    # text matrices are converted, rows can only be appended to binary ones
+    for name, dtype in [(X_name, feature_store.FEATURES_DTYPE),
+                        (y_name, feature_store.LABELS_DTYPE)]:
+        if feature_store.matrix_files(name)[0].endswith(
+                                            feature_store.TEXT_EXTENSION):
+            feature_store.convert_txt_matrix(name +
+                                    feature_store.TEXT_EXTENSION, dtype)
+
+    # the features must be extracted like the rows they are appended to
+    create_matrices.select_feature_set()
+    feature_set = create_matrices.get_feature_set()
+    cache = FeatureCache(create_matrices.feature_parameters())
+    start = 0
+    with feature_store.MatrixWriter(X_name, feature_set.width(),
+                                    append=True) as X_writer:
+        with feature_store.MatrixWriter(y_name,
+                dtype=feature_store.LABELS_DTYPE, append=True) as y_writer:
+            for features in feature_set.iter_extract(files):
+                X_writer.append(features)
+                y_writer.append(np.repeat(labels_list.index(theme),
+                                          len(features)))
+                for i in range(len(features)):
+                    cache.save(cache.key(files[start + i]), features[i])
+                start += len(features)
+    copy_to_theme_folder(files, theme)
+    return len(files)
+
+def main():
+    parser = argparse.ArgumentParser(description='Trains a classifier out of '
+                                     'core, chunk by chunk.')
+    subparsers = parser.add_subparsers(dest='command')
+    train_parser = subparsers.add_parser('train', help='train (or update) '
+                                         'the saved model of a mode')
+    append_parser = subparsers.add_parser('append', help='append new images '
+                                    'of a theme and update the saved model')
+    append_parser.add_argument('--theme', required=True)
+    append_parser.add_argument('images', nargs='+')
+    accuracy_parser = subparsers.add_parser('accuracy', help='test the '
+                                'accuracy of a mode with test_accuracy')
+    for subparser in [train_parser, append_parser, accuracy_parser]:
+        subparser.add_argument('--mode', default='sgd', choices=MODES)
+        subparser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    train_parser.add_argument('--from-scratch', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        clf = train(args.mode, args.chunk_size, args.from_scratch)
+        print('Trained %s model' % type(clf).__name__)
+    elif args.command == 'append':
+        appended = append_images(args.images, args.theme)
+        train(args.mode, args.chunk_size)
+        print('Appended %d images of %s and updated the model' % (appended,
+                                                                  args.theme))
+    elif args.command == 'accuracy':
+        classify_countries.test_accuracy(incremental=args.mode,
+                                         chunk_size=args.chunk_size)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper script with a lightweight instrumentation layer for the
+pipeline:
+
+    with instrumentation.stage('decode'):
+        ...
+    instrumentation.count('images_decoded', len(files))
+
+Stages can be nested (e.g. 'extract/train/hog'). For every stage the number of
+calls, the wall time and the CPU time are recorded. Optionally the top level
+stages are also profiled with cProfile and their peak Python memory is traced
+with tracemalloc (Python 3 only).
+
+Instrumentation is off by default and then costs almost nothing. It is
+switched on with the environment variable TOURIST_PROFILE or with enable(),
+e.g. by the --profile flag of classify_countries.py:
+
+    TOURIST_PROFILE=1                       timers and counters
+    TOURIST_PROFILE=cprofile,tracemalloc    also cProfile and tracemalloc
+
+At the end of a run a structured report is written to a JSON file
+(TOURIST_PROFILE_REPORT, default run_report.json) and a summary is printed.
+"""
+
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import collections
+import contextlib
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# environment variables that switch on the instrumentation and set the report
+PROFILE_VARIABLE = 'TOURIST_PROFILE'
+REPORT_VARIABLE = 'TOURIST_PROFILE_REPORT'
+
+# default file of the report
+REPORT_FILENAME = 'run_report.json'
+
+# number of functions listed in the cProfile statistics of a stage
+PROFILE_FUNCTIONS = 15
+
+# current state of the instrumentation
+_enabled = False
+_options = set()
+_started = time.time()
+_stages = collections.OrderedDict()
+_counters = collections.Counter()
+_lock = threading.Lock()
+_local = threading.local()
+
+# wall time of the blocks timed by imports(), also when the instrumentation is
+# off, and the number of these blocks that are open
+_import_time = 0.
+_import_depth = 0
+
+if hasattr(time, 'process_time'):
+    _cpu_time = time.process_time
+else:
+    _cpu_time = time.clock
+
+def enable(options='timers'):
+    """
+    Switches on the instrumentation.
+
+    Parameters
+    ----------
+    options : comma separated options. 'timers' records the stages and the
+            counters, 'cprofile' and 'tracemalloc' also profile the top level
+            stages.
+    """
+    global _enabled, _options
+    _enabled = True
+    _options = set(option.strip() for option in options.split(','))
+    if 'tracemalloc' in _options and tracemalloc is not None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    # worker processes started later inherit the instrumentation
+    os.environ[PROFILE_VARIABLE] = options
+
+def disable():
+    global _enabled
+    _enabled = False
+    os.environ.pop(PROFILE_VARIABLE, None)
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """
+    Forgets all the recorded stages and counters and the open stages of the
+    current thread (a forked worker process inherits the open stages of the
+    main process).
+    """
+    global _started
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+    del _stack()[:]
+    _started = time.time()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _record(path, wall, cpu, extra=None, calls=1):
+    with _lock:
+        if path not in _stages:
+            _stages[path] = {'calls' : 0, 'wall_s' : 0., 'cpu_s' : 0.}
+        entry = _stages[path]
+        entry['calls'] += calls
+        entry['wall_s'] += wall
+        entry['cpu_s'] += cpu
+        if extra:
+            entry.update(extra)
+
+@contextlib.contextmanager
+def _timed_stage(name):
+    stack = _stack()
+    path = '/'.join(stack + [name])
+    top_level = not stack
+    profiler = None
+    if top_level and 'cprofile' in _options:
+        profiler = cProfile.Profile()
+    trace = (top_level and 'tracemalloc' in _options and
+             tracemalloc is not None and tracemalloc.is_tracing())
+    if trace and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    trace_start = tracemalloc.get_traced_memory()[0] if trace else 0
+
+    stack.append(name)
+    wall_start = time.time()
+    cpu_start = _cpu_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall = time.time() - wall_start
+        cpu = _cpu_time() - cpu_start
+        stack.pop()
+
+        extra = dict()
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            extra['tracemalloc_peak_mb'] = (peak - trace_start) / (1024. *
+                                                                   1024.)
+        if profiler is not None:
+            stream = io.StringIO() if str is not bytes else io.BytesIO()
+            statistics = pstats.Stats(profiler, stream=stream)
+            statistics.sort_stats('cumulative').print_stats(PROFILE_FUNCTIONS)
+            extra['profile'] = stream.getvalue().splitlines()
+        _record(path, wall, cpu, extra)
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def stage(name):
+    """
+    Returns a context manager that times a stage of the pipeline.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _timed_stage(name)
+
+@contextlib.contextmanager
+def imports():
+    """
+    Times the imports of a block, e.g. the heavy modules that a function
+    imports when it is called. The time is added to import_time() and, when
+    the instrumentation is on, recorded as an 'import' stage.
+    """
+    global _import_time, _import_depth
+    _import_depth += 1
+    start = time.time()
+    try:
+        with stage('import'):
+            yield
+    finally:
+        _import_depth -= 1
+        # nested blocks are only counted once
+        if _import_depth == 0:
+            _import_time += time.time() - start
+
+def import_time():
+    """
+    Returns the wall time spent in the blocks timed by imports().
+    """
+    return _import_time
+
+def count(name, number=1):
+    """
+    Adds number to a counter (e.g. images decoded, rows predicted).
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += number
+
+def collect():
+    """
+    Returns the recorded stages and counters and forgets them. Used by worker
+    processes to send their measurements to the main process.
+    """
+    with _lock:
+        measurements = {'stages' : dict(_stages),
+                        'counters' : dict(_counters)}
+    reset()
+    return measurements
+
+def merge(measurements, prefix=None):
+    """
+    Adds the measurements of a worker process (see collect) to the current
+    ones. The stages of the worker are nested under prefix, which defaults to
+    the current stage.
+    """
+    if not _enabled or not measurements:
+        return
+    if prefix is None:
+        prefix = '/'.join(_stack())
+    for path, entry in measurements['stages'].items():
+        full_path = prefix + '/' + path if prefix else path
+        _record(full_path, entry['wall_s'], entry['cpu_s'],
+                calls=entry['calls'])
+    for name, number in measurements['counters'].items():
+        count(name, number)
+
+def report():
+    """
+    Returns the report of the run: the total time, every stage and every
+    counter.
+    """
+    with _lock:
+        return {'started' : time.ctime(_started),
+                'total_s' : time.time() - _started,
+                'options' : sorted(_options),
+                'stages' : dict(_stages),
+                'counters' : dict(_counters)}
+
+def write_report(path=None):
+    """
+    Writes the report of the run to a JSON file and prints a summary. Does
+    nothing if the instrumentation is off.
+    """
+    if not _enabled:
+        return None
+    if path is None:
+        path = os.environ.get(REPORT_VARIABLE, REPORT_FILENAME)
+    run_report = report()
+    with open(path, 'w') as report_file:
+        json.dump(run_report, report_file, indent=2, sort_keys=True)
+
+    print('%-40s %7s %10s %10s' % ('stage', 'calls', 'wall (s)', 'cpu (s)'))
+    for name in sorted(run_report['stages']):
+        entry = run_report['stages'][name]
+        print('%-40s %7d %10.3f %10.3f' % (name, entry['calls'],
+                                           entry['wall_s'], entry['cpu_s']))
+    for name in sorted(run_report['counters']):
+        print('%-40s %7d' % (name, run_report['counters'][name]))
+    print('Run report written to ' + path)
+    return path
+
+# switch on from the environment
+if os.environ.get(PROFILE_VARIABLE, '') not in ['', '0']:
+    enable('timers' if os.environ[PROFILE_VARIABLE] == '1'
+           else os.environ[PROFILE_VARIABLE])
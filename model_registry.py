@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper program that saves trained classifiers to disk so that they
+are not trained again on every run.
+
+A saved model is keyed by the classifier id, its hyperparameters and a
+fingerprint (hash) of the training data files. As long as these do not change
+the saved model is loaded instead of being trained again. The scikit-learn
+version is part of the key, so a model pickled by another version is never
+loaded.
+
+This program can run indepedently to manage the saved models:
+    python model_registry.py list
+    python model_registry.py warm --classifier 0
+    python model_registry.py evict <key> | --all
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import sklearn
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from sklearn.svm import SVC
+from sklearn.ensemble import VotingClassifier
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+import create_images_feature_matrices as create_matrices
+import feature_store
+import instrumentation
+from feature_cache import file_hash
+
+# folder of the saved models
+MODELS_PATH = 'models/'
+
+# file extensions of a saved model and of its description
+MODEL_EXTENSION = '.pkl'
+INFO_EXTENSION = '.json'
+
+def create_classifier(classifier=0):
+    """
+    Creates an untrained classifier.
+
+    Parameters
+    ----------
+    classifier : parameter to select which classifier to use.
+            Options:
+                0 : Random Forest Classifier
+                1 : Etremely Randomized Trees Classifier
+                2 or other : Voting Classifier with soft voting method
+                            utilizing:
+                                1) Random Forest Classifier with weight=2
+                                2) Etremely Randomized Trees Classifier with
+                                    weight=1.
+                                3) Support Vector Machine with weight=2.
+    """
+    if classifier == 0:
+        clf = RandomForestClassifier(n_estimators = 100)
+    elif classifier == 1:
+        clf = ExtraTreesClassifier(n_estimators = 100)
+    else:
+        clf1 = RandomForestClassifier(n_estimators = 30)
+        clf2 = ExtraTreesClassifier(n_estimators = 30)
+        clf3 = SVC(kernel='rbf', probability=True)
+        clf = VotingClassifier(estimators=[('rf', clf1), ('et', clf2),
+                                ('svc', clf3)], voting='soft', weights=[2,1,2])
+    return clf
+
+def data_fingerprint(matrices):
+    """
+    Returns a hash of the content of the files of a list of matrices.
+    """
+    sha = hashlib.sha1()
+    for name in matrices:
+        for path in feature_store.matrix_files(name):
+            sha.update(file_hash(path).encode('ascii'))
+    return sha.hexdigest()
+
+def model_key(clf, classifier, fingerprint, training=''):
+    """
+    Returns the key of a model: a hash of the scikit-learn version, the 
+    classifier id, the hyperparameters of the classifier, the fingerprint of 
+    the training data and a description of how the training data were 
+    selected from the matrices.
+    """
+    parameters = clf.get_params(deep=True)
+    description = '%s|%s|%s|%s|%s' % (sklearn.__version__, classifier, 
+                        repr(sorted(parameters.items())), fingerprint, training)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+
+def model_path(key):
+    return os.path.join(MODELS_PATH, key + MODEL_EXTENSION)
+
+def info_path(key):
+    return os.path.join(MODELS_PATH, key + INFO_EXTENSION)
+
+def save_model(key, clf, info):
+    """
+    Saves a trained classifier and its description.
+    """
+    if not os.path.isdir(MODELS_PATH):
+        os.makedirs(MODELS_PATH)
+    # models are not compressed, so that they are loaded fast
+    joblib.dump(clf, model_path(key))
+    info['size'] = os.path.getsize(model_path(key))
+    with open(info_path(key), 'w') as info_file:
+        json.dump(info, info_file, indent=2, sort_keys=True)
+
+def load_model(key):
+    """
+    Loads a saved classifier into memory. Memory maps would not help: the
+    trees of scikit-learn copy their arrays when they are unpickled.
+    """
+    return joblib.load(model_path(key))
+
+def get_model(classifier, X, y, matrices, training=''):
+    """
+    Returns a classifier trained on X and y. If the same classifier was already
+    trained on the same data, the saved model is loaded, otherwise the
+    classifier is trained and saved.
+
+    Parameters
+    ----------
+    classifier : classifier id (see create_classifier).
+
+    X, y : training data.
+
+    matrices : names of the matrices that X and y come from. Their content is
+            the fingerprint of the training data.
+
+    training : description of how X and y were selected from the matrices,
+            e.g. the parameters of a train/test split.
+    """
+    clf = create_classifier(classifier)
+    with instrumentation.stage('fingerprint'):
+        fingerprint = data_fingerprint(matrices)
+    key = model_key(clf, classifier, fingerprint, training)
+
+    if os.path.exists(model_path(key)) and os.path.exists(info_path(key)):
+        with instrumentation.stage('load_model'):
+            return load_model(key)
+
+    start = time.time()
+    with instrumentation.stage('fit'):
+        clf = clf.fit(X, y)
+    instrumentation.count('models_trained')
+    info = {'key' : key, 'classifier' : classifier,
+            'estimator' : type(clf).__name__, 'fingerprint' : fingerprint,
+            'matrices' : list(matrices), 'training' : training,
+            'fit_time' : time.time() - start, 'created' : time.ctime()}
+    save_model(key, clf, info)
+    return clf
+
+def list_models():
+    """
+    Returns the descriptions of all the saved models.
+    """
+    models = []
+    if not os.path.isdir(MODELS_PATH):
+        return models
+    for filename in sorted(os.listdir(MODELS_PATH)):
+        if filename.endswith(INFO_EXTENSION):
+            with open(os.path.join(MODELS_PATH, filename)) as info_file:
+                models.append(json.load(info_file))
+    return models
+
+def evict_model(key):
+    """
+    Deletes a saved model. Returns True if the model existed.
+    """
+    existed = False
+    for path in [model_path(key), info_path(key)]:
+        if os.path.exists(path):
+            os.remove(path)
+            existed = True
+    return existed
+
+def warm_model(classifier=0):
+    """
+    Trains (if needed) and saves the classifier that classify_countries uses.
+    """
+    train_X_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X'
+    train_y_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'
+    train_X = feature_store.load_matrix(train_X_name)
+    train_y = feature_store.load_matrix(train_y_name)
+    return get_model(classifier, train_X, train_y, [train_X_name,
+                                                    train_y_name])
+
+def main():
+    parser = argparse.ArgumentParser(description='Manages the saved models.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='list the saved models')
+    warm_parser = subparsers.add_parser('warm',
+                    help='train and save the model of classify_countries')
+    warm_parser.add_argument('--classifier', type=int, default=0)
+    evict_parser = subparsers.add_parser('evict',
+                    help='delete saved models')
+    evict_parser.add_argument('keys', nargs='*')
+    evict_parser.add_argument('--all', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        print('%-16s %-10s %-24s %8s %9s  %s' % ('key', 'classifier',
+                        'estimator', 'fit (s)', 'size (MB)', 'created'))
+        for info in list_models():
+            print('%-16s %-10s %-24s %8.1f %9.1f  %s' % (info['key'],
+                    info['classifier'], info['estimator'], info['fit_time'],
+                    info['size'] / (1024. * 1024.), info['created']))
+    elif args.command == 'warm':
+        warm_model(args.classifier)
+    elif args.command == 'evict':
+        keys = args.keys
+        if args.all:
+            keys = [info['key'] for info in list_models()]
+        for key in keys:
+            if evict_model(key):
+                print('Deleted model ' + key)
+            else:
+                print('No saved model ' + key)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper program that finds near-duplicate images (reposts, resized
+or recompressed copies) before their features are computed, so that they are
+neither decoded at full size nor counted twice in the votes of a country.
+
+Every image gets a 64 bit difference hash (dHash): the grayscale image is
+shrunk to 9x8 pixels and every bit tells whether a pixel is brighter than its
+left neighbour. JPEG images are decoded at a reduced scale for this, which is
+much cheaper than the full decode of the feature step. Two images are near
+duplicates when the Hamming distance of their hashes is at most MAX_DISTANCE.
+
+The hashes of every theme or country are kept in a BK-tree, so an image is
+only compared with a few of the earlier images of its group. The first image
+of a group is kept and its later near duplicates are skipped. Duplicates are
+only searched within a theme or country, never across them.
+
+With a feature cache the hash of every image is saved by the hash of its
+content (see feature_cache.py), so only new or changed images are decoded to
+find their near duplicates.
+
+The skipped images are listed in a report (DEDUP_REPORT_FILENAME).
+
+This program can run indepedently to report the duplicates of the image
+folders without creating any matrices:
+    python near_duplicates.py --max-distance 4
+"""
+
+import io
+import json
+import glob
+import hashlib
+import argparse
+import numpy as np
+from PIL import Image
+import instrumentation
+
+# size of the hash, the hash has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+# largest Hamming distance between the hashes of near duplicates
+MAX_DISTANCE = 4
+
+# file the duplicates are reported to
+DEDUP_REPORT_FILENAME = 'dedup_report.json'
+
+def dhash(file_, hash_size=HASH_SIZE):
+    """
+    Returns the difference hash of an image (file name or file object) as an
+    integer.
+    """
+    image = Image.open(file_)
+    # JPEG images are decoded at the smallest scale that is large enough
+    image.draft('L', (hash_size + 1, hash_size))
+    pixels = np.asarray(image.convert('L').resize([hash_size + 1, hash_size],
+                                                  Image.BILINEAR), dtype=int)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    hash_ = 0
+    for bit in np.flatnonzero(bits):
+        hash_ |= 1 << int(bit)
+    return hash_
+
+def hamming(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of hashes for Hamming distance searches. A node is
+    a tuple (hash, value, {distance : child node}).
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash_, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (hash_, value, dict())
+            return
+        node = self.root
+        while True:
+            distance = hamming(hash_, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (hash_, value, dict())
+                return
+            node = child
+
+    def search(self, hash_, max_distance):
+        """
+        Returns the sorted list of (distance, value) of the hashes within
+        max_distance of hash_.
+        """
+        results = []
+        nodes = [] if self.root is None else [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(hash_, node[0])
+            if distance <= max_distance:
+                results.append((distance, node[1]))
+            # by the triangle inequality only these children can match
+            for child_distance in node[2]:
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(node[2][child_distance])
+        results.sort()
+        return results
+
+class DuplicateIndex(object):
+    """
+    The hashes of the kept images of every group (theme or country).
+
+    Parameters
+    ----------
+    max_distance : largest Hamming distance between near duplicates.
+
+    cache : feature_cache.FeatureCache that keeps the hashes of the images,
+            or None to compute them on every run.
+    """
+    def __init__(self, max_distance=MAX_DISTANCE, cache=None):
+        self.max_distance = max_distance
+        self.cache = cache
+        self.trees = dict()
+        self.images = dict()
+        self.duplicates = dict()
+
+    def check(self, group, name, hash_):
+        """
+        Returns the name of an earlier image of the group that name is a near
+        duplicate of, or None if the image is new (it is then added to the
+        group).
+        """
+        tree = self.trees.setdefault(group, BKTree())
+        self.images[group] = self.images.get(group, 0) + 1
+        matches = tree.search(hash_, self.max_distance)
+        if matches:
+            distance, original = matches[0]
+            self.duplicates.setdefault(group, []).append([name, original,
+                                                          distance])
+            instrumentation.count('images_duplicate')
+            return original
+        tree.add(hash_, name)
+        return None
+
+    def image_hash(self, file_, data=None):
+        """
+        Returns the dHash of an image file, or of its bytes if they were
+        already read. Cached hashes are not computed again.
+        """
+        content_hash = None
+        if self.cache is not None:
+            if data is None:
+                content_hash = self.cache.content_hash(file_)
+            else:
+                content_hash = hashlib.sha1(data).hexdigest()
+            hash_ = self.cache.load_dhash(content_hash)
+            if hash_ is not None:
+                return hash_
+        # a reduced decode, but a decode like the ones of the features
+        instrumentation.count('images_decoded')
+        hash_ = dhash(file_ if data is None else io.BytesIO(data))
+        if content_hash is not None:
+            self.cache.save_dhash(content_hash, hash_)
+        return hash_
+
+    def unique_files(self, group, files):
+        """
+        Returns the images of a list that are not near duplicates of an
+        earlier image of the group.
+        """
+        with instrumentation.stage('dedup'):
+            return [file_ for file_ in files if self.check(group, file_,
+                                            self.image_hash(file_)) is None]
+
+    def report(self):
+        """
+        Returns the number of images, of kept images and the duplicates
+        (image, kept image, distance) of every group.
+        """
+        groups = dict()
+        for group in self.images:
+            duplicates = self.duplicates.get(group, [])
+            groups[group] = {'images' : self.images[group],
+                             'kept' : self.images[group] - len(duplicates),
+                             'duplicates' : duplicates}
+        return {'max_distance' : self.max_distance,
+                'images' : sum(self.images.values()),
+                'duplicates' : sum(len(duplicates) for duplicates
+                                   in self.duplicates.values()),
+                'groups' : groups}
+
+    def write_report(self, filename=DEDUP_REPORT_FILENAME):
+        report = self.report()
+        with open(filename, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        return report
+
+def main():
+    # imported here because create_images_feature_matrices uses this module
+    import create_images_feature_matrices as create_matrices
+    parser = argparse.ArgumentParser(description='Reports the near duplicate '
+                                     'images of the train and test folders.')
+    parser.add_argument('--max-distance', type=int, default=MAX_DISTANCE)
+    parser.add_argument('--output', default=DEDUP_REPORT_FILENAME)
+    args = parser.parse_args()
+
+    index = DuplicateIndex(args.max_distance)
+    for path in [create_matrices.TRAIN_DATA_PATH,
+                 create_matrices.TEST_DATA_PATH]:
+        for folder in sorted(glob.glob(path)):
+            index.unique_files(folder.split('/')[1], glob.glob(folder + '/*'))
+    report = index.write_report(args.output)
+    for group in sorted(report['groups']):
+        print('%-30s %6d images %6d duplicates' % (group,
+                report['groups'][group]['images'],
+                len(report['groups'][group]['duplicates'])))
+    print('Report written to ' + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program that creates the feature matrices of the train and test
+images (like create_images_feature_matrices.py) as a streaming pipeline:
+
+    reader thread  : lists the image files lazily, reads their bytes (and the
+                     cached features of unchanged images) and groups them in
+                     batches,
+    feature workers: processes that decode the images of a batch and compute
+                     their features (see feature_extractors.py),
+    writer         : the main process, which appends the rows of every batch
+                     to the output matrices in the original order (see
+                     feature_store.MatrixWriter) and saves new features to the
+                     feature cache.
+
+The stages are joined by bounded queues and at most max_in_flight batches are
+read but not yet written, so a slow stage blocks the ones before it
+(backpressure) and the memory used does not depend on the number of images.
+The disk reads of the reader overlap with the work of the feature workers.
+
+With --archives the images are read from tar or zip shards (see
+image_archives.py) instead of the image folders. The near duplicates of every
+theme and country are skipped by the reader (see near_duplicates.py).
+
+This program can run indepedently:
+    python streaming_ingest.py --workers 4
+    python streaming_ingest.py --archives
+"""
+
+import io
+import glob
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+import create_images_feature_matrices as create_matrices
+import batch_features
+import feature_store
+import image_archives
+import near_duplicates
+import instrumentation
+from feature_cache import FeatureCache
+
+# number of batches that can wait in each queue
+QUEUE_BATCHES = 8
+
+def train_items():
+    """
+    Returns the train themes and a generator of the train images. Every image
+    is a tuple (features matrix, labels matrix, image file, class, bytes of
+    the image or None to read the file).
+    """
+    folders = glob.glob(create_matrices.TRAIN_DATA_PATH)
+    themes = [folder.split('/')[1] for folder in folders]
+    features_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X'
+    labels_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'
+
+    def items():
+        for i in range(len(folders)):
+            for file_ in glob.iglob(folders[i] + '/*'):
+                yield features_name, labels_name, file_, i, None
+    return themes, items()
+
+def test_items():
+    """
+    Returns a generator of the test images. Every image is a tuple (features
+    matrix of its country, None, image file, None, None).
+    """
+    for folder in glob.glob(create_matrices.TEST_DATA_PATH):
+        country = folder.split('/')[1].split('_')[1]
+        features_name = (create_matrices.TEST_MATRICES_EXPORT_PATH + 'test_X_' +
+                         country)
+        for file_ in glob.iglob(folder + '/*'):
+            yield features_name, None, file_, None, None
+
+def archive_train_items(pattern):
+    """
+    Like train_items, for the images of the train archives that match a glob
+    pattern. The themes are numbered in the order they are first found, so
+    the list of themes is complete once all the images were read.
+    """
+    features_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_X'
+    labels_name = create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'train_y'
+    themes = []
+
+    def items():
+        for theme, name, data in image_archives.iter_images(pattern):
+            if theme not in themes:
+                themes.append(theme)
+            yield features_name, labels_name, name, themes.index(theme), data
+    return themes, items()
+
+def archive_test_items(pattern):
+    """
+    Like test_items, for the images of the test archives that match a glob
+    pattern.
+    """
+    for folder, name, data in image_archives.iter_images(pattern):
+        features_name = (create_matrices.TEST_MATRICES_EXPORT_PATH + 'test_X_' +
+                         folder.split('_')[1])
+        yield features_name, None, name, None, data
+
+def unique_items(items, index):
+    """
+    Yields the images of a generator of images that are not near duplicates
+    of an earlier image of their theme or country (the folder of the image).
+    The bytes of the yielded images are read.
+    """
+    for features_name, labels_name, file_, label, data in items:
+        if data is None:
+            with open(file_, 'rb') as image_file:
+                data = image_file.read()
+        with instrumentation.stage('dedup'):
+            duplicate = index.check(image_archives.member_folder(file_), file_,
+                                    index.image_hash(file_, data))
+        if duplicate is None:
+            yield features_name, labels_name, file_, label, data
+
+def read_images(items, tasks, in_flight, workers, cache, batch_size, status):
+    """
+    Reader stage: reads the images and puts batches of them in the tasks
+    queue. A batch never mixes output matrices.
+    """
+    batch = []
+    names = None
+    index = 0
+    try:
+        for features_name, labels_name, file_, label, data in items:
+            if batch and names != (features_name, labels_name):
+                in_flight.acquire()
+                tasks.put((index, names, batch))
+                index += 1
+                batch = []
+            names = (features_name, labels_name)
+
+            if data is None:
+                with open(file_, 'rb') as image_file:
+                    data = image_file.read()
+            key = None
+            cached = None
+            if cache is not None:
+                key = cache.data_key(data)
+                if cache.contains(key):
+                    cached = cache.load(key)
+                    data = None
+            batch.append((data, label, key, cached))
+
+            if len(batch) == batch_size:
+                in_flight.acquire()
+                tasks.put((index, names, batch))
+                index += 1
+                batch = []
+        if batch:
+            in_flight.acquire()
+            tasks.put((index, names, batch))
+    except Exception as error:
+        status['error'] = error
+    finally:
+        # tell every worker that there are no more batches
+        for i in range(workers):
+            tasks.put(None)
+
+def feature_worker(tasks, results, feature_set):
+    """
+    Feature stage: computes the features of the images of every batch that
+    are not cached. Runs in a worker process until it gets None.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            results.put(None)
+            break
+        index, names, batch = task
+        try:
+            missing = [i for i in range(len(batch)) if batch[i][3] is None]
+            rows = [item[3] for item in batch]
+            if missing:
+                computed = feature_set.extract([io.BytesIO(batch[i][0]) 
+                                                for i in missing])
+                for j in range(len(missing)):
+                    rows[missing[j]] = computed[j]
+            results.put((index, names, np.array(rows,
+                                        dtype=feature_store.FEATURES_DTYPE),
+                         [item[1] for item in batch],
+                         [batch[i][2] for i in missing], missing))
+        except Exception as error:
+            results.put((index, names, error))
+
+def ingest(items, workers=1, cache=None, batch_size=batch_features.BATCH_SIZE,
+           max_in_flight=None):
+    """
+    Runs the streaming pipeline on a generator of images and writes their
+    feature (and label) matrices. Returns the number of images and the number
+    of decoded (not cached) images.
+
+    Parameters
+    ----------
+    items : generator of tuples (features matrix, labels matrix or None,
+            image file, label, bytes of the image or None).
+
+    workers : number of feature worker processes.
+
+    cache : FeatureCache to reuse the features of unchanged images.
+
+    batch_size : number of images of a batch.
+
+    max_in_flight : maximum number of batches read but not yet written.
+    """
+    if max_in_flight is None:
+        max_in_flight = QUEUE_BATCHES + 2 * workers
+    tasks = multiprocessing.Queue(QUEUE_BATCHES)
+    results = multiprocessing.Queue(QUEUE_BATCHES)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    status = dict()
+
+    processes = [multiprocessing.Process(target=feature_worker,
+                        args=(tasks, results,
+                              create_matrices.get_feature_set()))
+                 for i in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    reader = threading.Thread(target=read_images, args=(items, tasks,
+                        in_flight, workers, cache, batch_size, status))
+    reader.daemon = True
+    reader.start()
+
+    # writer stage: write the batches in their original order
+    pending = dict()
+    next_index = 0
+    finished = 0
+    images = 0
+    decoded = 0
+    names = None
+    writers = []
+    # matrices that were written, the images of a matrix that come back later
+    # (e.g. a country split between two archives) are appended to it
+    written = set()
+    try:
+        while finished < workers:
+            result = results.get()
+            if result is None:
+                finished += 1
+                continue
+            if isinstance(result[2], Exception):
+                raise result[2]
+            pending[result[0]] = result
+            while next_index in pending:
+                index, batch_names, rows, labels, keys, missing = \
+                                                    pending.pop(next_index)
+                with instrumentation.stage('write'):
+                    if batch_names != names:
+                        for writer in writers:
+                            writer.close()
+                        names = batch_names
+                        append = names in written
+                        written.add(names)
+                        writers = [feature_store.MatrixWriter(names[0],
+                                                rows.shape[1], append=append)]
+                        if names[1] is not None:
+                            writers.append(feature_store.MatrixWriter(
+                                names[1], dtype=feature_store.LABELS_DTYPE,
+                                append=append))
+                    writers[0].append(rows)
+                    if names[1] is not None:
+                        writers[1].append(labels)
+                    if cache is not None:
+                        for key, i in zip(keys, missing):
+                            cache.save(key, rows[i])
+                images += len(rows)
+                decoded += len(missing)
+                in_flight.release()
+                next_index += 1
+    finally:
+        for writer in writers:
+            writer.close()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    reader.join()
+    if 'error' in status:
+        raise status['error']
+
+    instrumentation.count('images_decoded', decoded)
+    instrumentation.count('images_cached', images - decoded)
+    return images, decoded
+
+def create_data(workers=1, use_cache=True, archives=False, dedup=True,
+                features=None, image_size=None):
+    """
+    Creates the feature matrices of the train and the test images with the
+    streaming pipeline. Returns the number of decoded images and the number
+    of removed cache entries.
+
+    Parameters
+    ----------
+    workers : number of feature worker processes.
+
+    use_cache : if True the features of unchanged images are read from the
+            feature cache.
+
+    archives : if True the images are read from the archives of
+            create_matrices.TRAIN_ARCHIVES_PATH and TEST_ARCHIVES_PATH.
+
+    dedup : if True the near duplicates of every theme and country are
+            skipped and reported to near_duplicates.DEDUP_REPORT_FILENAME.
+
+    features, image_size : feature set and image size (see
+            create_matrices.select_feature_set). None keeps the ones of the
+            existing matrices.
+    """
+    create_matrices.select_feature_set(features, image_size)
+    cache = None
+    if use_cache:
+        cache = FeatureCache(create_matrices.feature_parameters())
+    index = None
+    if dedup:
+        index = near_duplicates.DuplicateIndex(cache=cache)
+
+    if archives:
+        train_path = create_matrices.TRAIN_ARCHIVES_PATH
+        test_path = create_matrices.TEST_ARCHIVES_PATH
+        themes, items = archive_train_items(train_path)
+    else:
+        train_path = create_matrices.TRAIN_DATA_PATH
+        test_path = create_matrices.TEST_DATA_PATH
+        themes, items = train_items()
+    if index is not None:
+        items = unique_items(items, index)
+    with instrumentation.stage('train'):
+        images, decoded = ingest(items, workers, cache)
+    if images == 0:
+        print('No train images found in ' + train_path)
+    train_keys = 0 if cache is None else len(cache.used_keys)
+    with open(create_matrices.TRAIN_MATRICES_EXPORT_PATH + 'class_themes.txt',
+              'w') as class_file:
+        for theme in themes:
+            class_file.write(theme + '\n')
+    create_matrices.save_feature_set()
+
+    with instrumentation.stage('test'):
+        if archives:
+            items = archive_test_items(test_path)
+        else:
+            items = test_items()
+        if index is not None:
+            items = unique_items(items, index)
+        images, test_decoded = ingest(items, workers, cache)
+    if images == 0:
+        print('No test images found in ' + test_path)
+
+    if index is not None:
+        index.write_report()
+
+    # the entries of the train or the test images are kept if they were not
+    # found (see create_matrices.create_data)
+    removed = 0
+    if cache is not None and 0 < train_keys < len(cache.used_keys):
+        removed = cache.prune()
+    if cache is not None:
+        cache.save_dhashes()
+    return decoded + test_decoded, removed
+
+def main():
+    parser = argparse.ArgumentParser(description='Creates the feature '
+                    'matrices of the train and test images as a streaming '
+                    'pipeline.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of feature worker processes (0 uses all '
+                        'the cores)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='compute the features of all the images')
+    parser.add_argument('--archives', action='store_true',
+                        help='read the images from the tar or zip shards of '
+                        'the train and test archives')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='keep the near duplicate images')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    decoded, removed = create_data(workers, not args.no_cache, args.archives,
+                                   not args.no_dedup)
+    print('Computed the features of %d new or changed images' % decoded)
+    print('Removed %d old entries from the feature cache' % removed)
+
+if __name__ == '__main__':
+    main()
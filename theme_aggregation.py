@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+This is a helper script that aggregates the class probabilities (predict_proba)
+of the images of many countries into a score for every theme of every
+country. The probabilities are added batch by batch, so the images of a
+country never have to be in memory at the same time.
+
+Aggregation modes:
+    vote : share of the images whose most probable theme is the theme
+           (the hard vote of the images).
+    mean : mean probability of the theme over the images.
+    log  : mean log-probability of the theme over the images, normalized with
+           a softmax (the normalized geometric mean of the probabilities).
+    topk : share of the votes of the theme when every image votes for its
+           top_k most probable themes.
+
+The main theme of a country is the theme with the highest score. Ties are
+broken deterministically: by the mean probability (or by the votes in mean
+mode) and then by the order of the themes. The confidence of a country is the
+score of its main theme.
+"""
+
+import numpy as np
+
+# aggregation modes
+MODES = ['vote', 'mean', 'log', 'topk']
+
+# smallest probability used by the log mode
+MIN_PROBABILITY = 1e-6
+
+class ThemeAggregator(object):
+    """
+    Adds up the class probabilities of the images of many countries.
+
+    Parameters
+    ----------
+    labels_number : number of themes.
+
+    countries_number : number of countries.
+
+    mode : aggregation mode ('vote', 'mean', 'log' or 'topk').
+
+    top_k : number of themes every image votes for in topk mode.
+    """
+    def __init__(self, labels_number, countries_number, mode='vote',
+                 top_k=2):
+        if mode not in MODES:
+            raise ValueError('Unknown aggregation mode ' + str(mode))
+        self.labels_number = labels_number
+        self.mode = mode
+        self.top_k = max(1, min(top_k, labels_number))
+        self.rows = np.zeros([countries_number])
+        self.votes = np.zeros([countries_number, labels_number])
+        self.probabilities = np.zeros([countries_number, labels_number])
+        self.log_probabilities = np.zeros([countries_number, labels_number])
+        self.top_votes = np.zeros([countries_number, labels_number])
+
+    def update(self, probabilities, offsets, countries, columns=None):
+        """
+        Adds a batch of class probabilities.
+
+        Parameters
+        ----------
+        probabilities : (rows, classes) output of predict_proba.
+
+        offsets, countries : the rows of countries[i] are
+                probabilities[offsets[i]:offsets[i + 1]] (see
+                classify_countries.iter_country_batches).
+
+        columns : theme of every column of probabilities (clf.classes_).
+                None if the columns are already all the themes in order.
+        """
+        if columns is not None:
+            # themes that the classifier never saw have probability 0
+            full = np.zeros([len(probabilities), self.labels_number])
+            full[:, np.asarray(columns).astype(int)] = probabilities
+            probabilities = full
+        starts = np.asarray(offsets[:-1])
+        countries = np.asarray(countries)
+        np.add.at(self.rows, countries, np.diff(offsets))
+
+        best = np.zeros(probabilities.shape)
+        best[np.arange(len(probabilities)), probabilities.argmax(axis=1)] = 1
+        np.add.at(self.votes, countries, np.add.reduceat(best, starts))
+
+        np.add.at(self.probabilities, countries,
+                  np.add.reduceat(probabilities, starts))
+
+        if self.mode == 'log':
+            np.add.at(self.log_probabilities, countries, np.add.reduceat(
+                np.log(np.maximum(probabilities, MIN_PROBABILITY)), starts))
+        elif self.mode == 'topk':
+            top = np.zeros(probabilities.shape)
+            top_columns = np.argsort(-probabilities, axis=1,
+                                     kind='mergesort')[:, :self.top_k]
+            top[np.arange(len(probabilities))[:, None], top_columns] = 1
+            np.add.at(self.top_votes, countries,
+                      np.add.reduceat(top, starts))
+
+    def scores(self):
+        """
+        Returns the (countries, themes) scores of the aggregation mode. The
+        scores of a country sum to 1 (0 for a country without images).
+        """
+        rows = np.maximum(self.rows, 1)[:, None]
+        if self.mode == 'vote':
+            return self.votes / rows
+        if self.mode == 'mean':
+            return self.probabilities / rows
+        if self.mode == 'topk':
+            return self.top_votes / (rows * self.top_k)
+        mean_log = self.log_probabilities / rows
+        scores = np.exp(mean_log - mean_log.max(axis=1)[:, None])
+        scores /= scores.sum(axis=1)[:, None]
+        scores[self.rows == 0] = 0
+        return scores
+
+    def main_themes(self):
+        """
+        Returns the index of the main theme and the confidence of every
+        country.
+        """
+        scores = self.scores()
+        rows = np.maximum(self.rows, 1)[:, None]
+        if self.mode == 'mean':
+            tie_scores = self.votes / rows
+        else:
+            tie_scores = self.probabilities / rows
+        order = np.arange(self.labels_number)
+        themes = np.array([np.lexsort((order, -tie_scores[i], -scores[i]))[0]
+                           for i in range(len(scores))], dtype=int)
+        return themes, scores[np.arange(len(scores)), themes]
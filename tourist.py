@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+This is a program with a single command line for every step of the pipeline:
+
+    extract  : creates the feature matrices (create_images_feature_matrices.py)
+    evaluate : tests the accuracy of a classifier (test_accuracy)
+    classify : classifies the countries and draws their bar charts
+    map      : draws the world map of the main themes
+
+Every subcommand imports only the modules it needs when it runs, so e.g.
+extract never loads scikit-learn, matplotlib or cartopy. With --timing the
+time spent importing the modules of the command line, importing the modules
+of the subcommand (also the heavy modules that its functions import when they
+are called, see instrumentation.imports) and running it is printed, with the
+heavy libraries that were loaded. "python -X importtime tourist.py ..." lists
+every import.
+
+This program can run indepedently:
+    python tourist.py extract --workers 4
+    python tourist.py evaluate --classifier 0
+    python tourist.py classify --mode mean --timing
+    python tourist.py map
+"""
+
+import time
+
+# start of the run, before any other module is imported
+START_TIME = time.time()
+
+import sys
+import argparse
+import importlib
+import instrumentation
+
+# time spent importing the modules of the command line
+STARTUP_TIME = time.time() - START_TIME
+
+# libraries that are slow to import, reported by --timing
+HEAVY_MODULES = ['sklearn', 'scipy', 'skimage', 'matplotlib', 'cartopy',
+                 'shapely', 'iso3166', 'joblib']
+
+def import_modules(names):
+    """
+    Imports the modules a subcommand needs and returns them.
+    """
+    with instrumentation.imports():
+        return [importlib.import_module(name) for name in names]
+
+def command_extract(args):
+    create_matrices = import_modules(['create_images_feature_matrices'])[0]
+    with instrumentation.stage('extract'):
+        if args.stream or args.archives:
+            streaming_ingest = import_modules(['streaming_ingest'])[0]
+            decoded, removed = streaming_ingest.create_data(args.workers,
+                        not args.no_cache, args.archives, not args.no_dedup,
+                        args.features, args.image_size)
+        else:
+            decoded, removed = create_matrices.create_data(args.workers,
+                                        not args.no_cache, not args.no_dedup,
+                                        args.features, args.image_size)
+    print('Computed the features of %d new or changed images' % decoded)
+    print('Removed %d old entries from the feature cache' % removed)
+
+def command_evaluate(args):
+    classify_countries = import_modules(['classify_countries'])[0]
+    with instrumentation.stage('evaluate'):
+        classify_countries.test_accuracy(args.classifier, args.matrices,
+                                         args.incremental)
+
+def command_classify(args):
+    classify_countries = import_modules(['classify_countries'])[0]
+    mode = args.mode or classify_countries.AGGREGATION_MODE
+    with instrumentation.stage('classify'):
+        classify_countries.classify_countries(args.classifier,
+                                              features=args.matrices,
+                                              chart_workers=args.chart_workers,
+                                              mode=mode, top_k=args.top_k)
+
+def command_map(args):
+    create_world_map_graph = import_modules(['create_world_map_graph'])[0]
+    with instrumentation.stage('world_map'):
+        create_world_map_graph.create_world_map()
+
+def print_timing(command, import_time, run_time):
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    print('Startup %.3f s, %s imports %.3f s, run %.3f s' % (STARTUP_TIME,
+                                            command, import_time, run_time))
+    print('Heavy modules loaded: %s' % (', '.join(heavy) or 'none'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Tourist theme '
+                                     'classification of countries.')
+    parser.add_argument('--profile', nargs='?', const='timers',
+                        help='time the stages and write a run report '
+                        '(timers, cprofile, tracemalloc)')
+    parser.add_argument('--timing', action='store_true',
+                        help='print the import and startup time')
+    subparsers = parser.add_subparsers(dest='command')
+
+    extract_parser = subparsers.add_parser('extract', help='create the '
+                                           'feature matrices')
+    extract_parser.add_argument('--workers', type=int, default=1)
+    extract_parser.add_argument('--no-cache', action='store_true')
+    extract_parser.add_argument('--no-dedup', action='store_true')
+    extract_parser.add_argument('--stream', action='store_true')
+    extract_parser.add_argument('--archives', action='store_true')
+    extract_parser.add_argument('--features', help='feature set (see '
+                                'feature_extractors.py)')
+    extract_parser.add_argument('--image-size', type=int)
+    extract_parser.set_defaults(function=command_extract)
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='test the '
+                                            'accuracy of a classifier')
+    evaluate_parser.add_argument('--incremental', help='training mode of '
+                                 'incremental_training.py')
+    classify_parser = subparsers.add_parser('classify', help='classify the '
+                                            'countries')
+    classify_parser.add_argument('--chart-workers', type=int, default=1)
+    classify_parser.add_argument('--mode', help='aggregation mode (see '
+                                 'theme_aggregation.py, default vote)')
+    classify_parser.add_argument('--top-k', type=int, default=2)
+    for subparser in [evaluate_parser, classify_parser]:
+        subparser.add_argument('--classifier', type=int, default=0)
+        subparser.add_argument('--matrices', help='feature configuration of '
+                               'feature_reduction.py')
+    evaluate_parser.set_defaults(function=command_evaluate)
+    classify_parser.set_defaults(function=command_classify)
+
+    map_parser = subparsers.add_parser('map', help='draw the world map')
+    map_parser.set_defaults(function=command_map)
+    args = parser.parse_args()
+
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.profile:
+        instrumentation.enable(args.profile)
+    if args.command == 'extract' and args.workers <= 0:
+        import multiprocessing
+        args.workers = multiprocessing.cpu_count()
+
+    start = time.time()
+    args.function(args)
+    # the imports of the subcommand are not part of its run time
+    import_time = instrumentation.import_time()
+    run_time = time.time() - start - import_time
+    instrumentation.write_report()
+    if args.timing:
+        print_timing(args.command, import_time, run_time)
+
+if __name__ == '__main__':
+    main()